@@ -1,6 +1,8 @@
 # encoding: utf-8
 
 from collections import Counter
+import hashlib
+import os
 import re
 import numpy as np
 from numpy.random import choice as random_choice
@@ -38,51 +40,96 @@ class DataSet(object):
     Loads news articles from a file, generates misspellings and vectorizes examples.
     """
 
-    def __init__(self, dataset_filename, test_set_fraction=0.1, inverted=True):
+    def __init__(self, dataset_filename, test_set_fraction=0.1, inverted=True, index_input=False,
+                 fresh_noise=False, cache_dirname=None):
         self.inverted = inverted
-
-        news = self.read_news(dataset_filename)
-        questions, answers = self.generate_examples(news)
-
-        chars_answer = set.union(*(set(answer) for answer in answers))
-        chars_question = set.union(*(set(question) for question in questions))
-        self.chars = sorted(list(set.union(chars_answer, chars_question)))
-        self.character_table = CharacterTable(self.chars)
+        self.index_input = index_input
+        self.fresh_noise = fresh_noise
+
+        cache_filename = None
+        if cache_dirname is not None:
+            cache_filename = os.path.join(cache_dirname,
+                                          'examples-{}.npz'.format(self.cache_key(dataset_filename, inverted)))
+
+        if cache_filename is not None and os.path.exists(cache_filename):
+            print("Loading examples from {}".format(cache_filename))
+            with np.load(cache_filename) as cache:
+                self.chars = [str(c) for c in cache['chars']]
+                questions, answers, lengths = cache['questions'], cache['answers'], cache['lengths']
+            self.character_table = CharacterTable(self.chars)
+            self.noise = NoiseGenerator(self.character_table, AMOUNT_OF_NOISE, MAX_INPUT_LEN, inverted)
+        else:
+            news = self.read_news(dataset_filename)
+            answers, lengths = self.generate_examples(news)
+
+            # The noise alphabet is always part of the table, so fresh corruptions stay encodable
+            self.chars = sorted(set.union(set(CHARS), *(set(answer) for answer in answers)))
+            self.character_table = CharacterTable(self.chars)
+            self.noise = NoiseGenerator(self.character_table, AMOUNT_OF_NOISE, MAX_INPUT_LEN, inverted)
+
+            answers = self.character_table.encode_indices(answers, MAX_INPUT_LEN)
+            questions = self.noise(answers, lengths)
+            print("Generated questions and answers")
+
+            if cache_filename is not None:
+                self.save_examples(cache_filename, questions, answers, lengths)
 
         split_at = int(len(questions) * (1 - test_set_fraction))
-        (self.questions_train, self.questions_dev) = (questions[:split_at], questions[split_at:])
-        (self.answers_train, self.answers_dev) = (answers[:split_at], answers[split_at:])
+        (self.x_train, self.x_dev) = (questions[:split_at], questions[split_at:])
+        (self.y_train, self.y_dev) = (answers[:split_at], answers[split_at:])
+        (self.lengths_train, self.lengths_dev) = (lengths[:split_at], lengths[split_at:])
 
-        self.x_max_length = max(len(question) for question in questions)
-        self.y_max_length = max(len(answer) for answer in answers)
+        self.x_max_length = questions.shape[1]
+        self.y_max_length = answers.shape[1]
 
-        self.train_set_size = len(self.questions_train)
-        self.dev_set_size = len(self.questions_dev)
+        self.train_set_size = len(self.x_train)
+        self.dev_set_size = len(self.x_dev)
 
         print("Completed pre-processing")
 
+    @staticmethod
+    def cache_key(dataset_filename, inverted):
+        """sha1 of the corpus contents and of every parameter the generated examples depend on,
+        including inverted, as the cached questions are stored reversed"""
+        sha1 = hashlib.sha1()
+        with open(dataset_filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        params = (MAX_INPUT_LEN, MIN_INPUT_LEN, AMOUNT_OF_NOISE, NUMBER_OF_CHARS, ''.join(CHARS), inverted)
+        sha1.update(repr(params).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def save_examples(self, cache_filename, questions, answers, lengths):
+        """Persist the encoded examples, keyed by cache_key, so restarts skip preprocessing"""
+        if not os.path.exists(os.path.dirname(cache_filename) or '.'):
+            os.makedirs(os.path.dirname(cache_filename))
+        with open(cache_filename + '.tmp', 'wb') as f:
+            np.savez(f, chars=np.array(self.chars), questions=questions, answers=answers, lengths=lengths)
+        os.rename(cache_filename + '.tmp', cache_filename)
+        print("Saved examples to {}".format(cache_filename))
+
     def train_set_batch_generator(self, batch_size):
-        return self.batch_generator(self.questions_train, self.answers_train, batch_size)
+        # With fresh_noise, every training batch gets new corruptions of its clean answers
+        lengths = self.lengths_train if self.fresh_noise else None
+        return self.batch_generator(self.x_train, self.y_train, batch_size, lengths)
 
     def dev_set_batch_generator(self, batch_size):
-        return self.batch_generator(self.questions_dev, self.answers_dev, batch_size)
+        return self.batch_generator(self.x_dev, self.y_dev, batch_size)
 
-    def batch_generator(self, questions, answers, batch_size):
+    def batch_generator(self, x_indices, y_indices, batch_size, lengths=None):
+        """Endlessly yield batches from pre-encoded index arrays, wrapping around at the end.
+        If the answer lengths are given, questions are regenerated from the answers with fresh noise."""
         start_index = 0
 
         while True:
-            questions_batch = []
-            answers_batch = []
-
-            while len(questions_batch) < batch_size:
-                take = min(len(questions) - start_index, batch_size - len(questions_batch))
-
-                questions_batch.extend(questions[start_index: start_index + take])
-                answers_batch.extend(answers[start_index: start_index + take])
+            rows = np.arange(start_index, start_index + batch_size) % len(x_indices)
+            start_index = (start_index + batch_size) % len(x_indices)
 
-                start_index = (start_index + take) % len(questions)
-
-            yield self.vectorize(questions_batch, answers_batch)
+            y = y_indices[rows]
+            X = x_indices[rows] if lengths is None else self.noise(y, lengths[rows])
+            if not self.index_input:
+                X = self.character_table.one_hot(X)
+            yield X, self.character_table.one_hot(y)
 
     def add_noise_to_string(self, a_string, amount_of_noise):
         """Add some artificial spelling mistakes to the string"""
@@ -112,19 +159,10 @@ class DataSet(object):
 
         assert len(questions) == len(answers)
 
-        X = np_zeros((len(questions), self.x_max_length, self.character_table.size), dtype=np.bool)
-
-        for i in range(len(questions)):
-            sentence = questions[i]
-            for j, c in enumerate(sentence):
-                X[i, j, self.character_table.char_indices[c]] = 1
-
-        y = np_zeros((len(answers), self.y_max_length, self.character_table.size), dtype=np.bool)
-
-        for i in range(len(answers)):
-            sentence = answers[i]
-            for j, c in enumerate(sentence):
-                y[i, j, self.character_table.char_indices[c]] = 1
+        X = self.character_table.encode_indices(questions, self.x_max_length)
+        if not self.index_input:
+            X = self.character_table.one_hot(X)
+        y = self.character_table.one_hot(self.character_table.encode_indices(answers, self.y_max_length))
 
         return X, y
 
@@ -141,40 +179,48 @@ class DataSet(object):
 
         return text
 
+    def clean_lines(self, dataset_filename):
+        """Stream the cleaned lines of the corpus file"""
+        with open(dataset_filename, encoding='utf-8') as news:
+            for line in news:
+                yield self.clean_text(line)
+
     def read_news(self, dataset_filename):
-        """Read the news corpus"""
+        """Read the news corpus in two streaming passes: count characters, then stream the lines made
+        only of the most popular ones. No line is kept here; generate_examples consumes them one at a
+        time, so memory grows with the unique answers rather than with the corpus."""
         print("Reading news")
-        news = open(dataset_filename, encoding='utf-8').read()
-        print("Read news")
-
-        lines = [line for line in news.split('\n')]
-        print("Read {} lines of input corpus".format(len(lines)))
-
-        lines = [self.clean_text(line) for line in lines]
-        print("Cleaned text")
-
         counter = Counter()
-        for line in lines:
-            counter += Counter(line)
+        line_count = 0
+        for line in self.clean_lines(dataset_filename):
+            counter.update(line)
+            line_count += 1
+        print("Read {} lines of input corpus".format(line_count))
 
         most_popular_chars = {key for key, _value in counter.most_common(NUMBER_OF_CHARS)}
         print(most_popular_chars)
 
-        lines = [line for line in lines if line and not bool(set(line) - most_popular_chars)]
-        print("Left with {} lines of input corpus".format(len(lines)))
+        return self.kept_lines(dataset_filename, most_popular_chars)
 
-        return lines
+    def kept_lines(self, dataset_filename, allowed_chars):
+        """Stream the cleaned, non-empty lines made only of allowed_chars"""
+        kept_count = 0
+        for line in self.clean_lines(dataset_filename):
+            if line and allowed_chars.issuperset(line):
+                kept_count += 1
+                yield line
+        print("Left with {} lines of input corpus".format(kept_count))
 
     def generate_examples(self, corpus):
-        """Generate examples of misspellings"""
+        """Cut an iterable of corpus lines into unique answers; returns them shuffled and '.'-padded,
+        with their lengths. The misspelled questions are made from these by a NoiseGenerator.
+        The answers themselves are held in memory, so their number still bounds its use."""
 
         print("Generating examples")
 
-        questions, answers, seen_answers = [], [], set()
-
-        while corpus:
-            line = corpus.pop()
+        answers, seen_answers = [], set()
 
+        for line in corpus:
             while len(line) > MIN_INPUT_LEN:
                 if len(line) <= MAX_INPUT_LEN:
                     answer = line
@@ -202,19 +248,76 @@ class DataSet(object):
         random_shuffle(answers)
         print("Shuffled")
 
-        for answer_index, answer in enumerate(answers):
-            question = self.add_noise_to_string(answer, AMOUNT_OF_NOISE)
-            question += '.' * (MAX_INPUT_LEN - len(question))
-            answer += "." * (MAX_INPUT_LEN - len(answer))
-            answers[answer_index] = answer
-            assert len(answer) == MAX_INPUT_LEN
+        lengths = np.array([len(answer) for answer in answers], dtype=np.int8)
+        answers = [answer + "." * (MAX_INPUT_LEN - len(answer)) for answer in answers]
+
+        return answers, lengths
 
-            question = question[::-1] if self.inverted else question
-            questions.append(question)
 
-        print("Generated questions and answers")
+class NoiseGenerator(object):
+    """
+    Vectorized add_noise_to_string over '.'-padded index arrays of answers: the same replace, delete,
+    insert and transpose mistakes with the same probabilities, drawn independently for every row.
+    Questions come out padded to max_length and reversed if inverted.
+    """
 
-        return questions, answers
+    def __init__(self, character_table, amount_of_noise, max_length, inverted=True, chunk_size=65536):
+        self.amount_of_noise = amount_of_noise
+        self.max_length = max_length
+        self.inverted = inverted
+        self.chunk_size = chunk_size
+        self.noise_indices = np.array([character_table.char_indices[c] for c in CHARS[:-1]], dtype=np.int8)
+        self.fill_index = character_table.char_indices['.']
+
+    def __call__(self, answers, lengths):
+        if len(answers) <= self.chunk_size:
+            return self.add_noise(answers, lengths)
+        return np.concatenate([self.add_noise(answers[i:i + self.chunk_size], lengths[i:i + self.chunk_size])
+                               for i in range(0, len(answers), self.chunk_size)])
+
+    def positions(self, lengths):
+        """A uniform random position below each length"""
+        return (rand(len(lengths)) * np.maximum(lengths, 1)).astype(np.int64)
+
+    def add_noise(self, answers, lengths):
+        n = len(answers)
+        rows = np.arange(n)
+        # One spare column, so an insertion never pushes a character out
+        columns = np.arange(self.max_length + 1)
+        X = np.full((n, self.max_length + 1), self.fill_index, dtype=np.int8)
+        X[:, :answers.shape[1]] = answers
+        lengths = lengths.astype(np.int64)
+
+        # Replace a character with a random character
+        hit = rand(n) < self.amount_of_noise * lengths
+        position = self.positions(lengths)[hit]
+        X[rows[hit], position] = random_choice(self.noise_indices, len(position))
+
+        # Delete a character
+        hit = rand(n) < self.amount_of_noise * lengths
+        shift = hit[:, None] & (columns >= self.positions(lengths)[:, None])
+        X = X[rows[:, None], np.minimum(columns + shift, self.max_length)]
+        lengths -= hit
+
+        # Add a random character
+        hit = (lengths < self.max_length) & (rand(n) < self.amount_of_noise * lengths)
+        position = self.positions(lengths)
+        X = X[rows[:, None], columns - (hit[:, None] & (columns > position[:, None]))]
+        X[rows[hit], position[hit]] = random_choice(self.noise_indices, hit.sum())
+        lengths += hit
+
+        # Transpose 2 characters
+        hit = rand(n) < self.amount_of_noise * lengths
+        position = self.positions(lengths - 1)[hit]
+        swapped = X[rows[hit], position]
+        X[rows[hit], position] = X[rows[hit], position + 1]
+        X[rows[hit], position + 1] = swapped
+
+        X = X[:, :self.max_length]
+        X[columns[None, :self.max_length] >= lengths[:, None]] = self.fill_index
+        if self.inverted:
+            X = X[:, ::-1]
+        return np.ascontiguousarray(X)
 
 
 class CharacterTable(object):
@@ -230,6 +333,21 @@ class CharacterTable(object):
         self.char_indices = dict((c, i) for i, c in enumerate(self.chars))
         self.indices_char = dict((i, c) for i, c in enumerate(self.chars))
         self.size = len(self.chars)
+        # Index `size` marks padding and maps to an all-zero row
+        assert self.size < np.iinfo(np.int8).max
+        self.pad_index = self.size
+        self.one_hot_table = np.eye(self.size + 1, self.size, dtype=np.bool)
+
+    def encode_indices(self, strings, maxlen):
+        """Encode strings as an int8 array of character indices, padded with pad_index"""
+        X = np.full((len(strings), maxlen), self.pad_index, dtype=np.int8)
+        for i, string in enumerate(strings):
+            X[i, :len(string)] = [self.char_indices[c] for c in string]
+        return X
+
+    def one_hot(self, indices):
+        """One-hot encode an index array; padding becomes all-zero rows"""
+        return self.one_hot_table[indices]
 
     def encode(self, C, maxlen):
         """Encode as one-hot"""
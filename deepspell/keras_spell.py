@@ -31,6 +31,8 @@ random_seed(123)  # Reproducibility
 
 # Parameters for the model and dataset
 DATASET_FILENAME = 'data/dataset/news.2011.en.shuffled'
+DATASET_CACHE_DIRECTORYNAME = 'data/cache'
+FRESH_NOISE = True  # New spelling mistakes for every training batch
 NUMBER_OF_EPOCHS = 100000
 RNN = recurrent.LSTM
 INPUT_LAYERS = 2
@@ -139,7 +141,7 @@ def save_dataset_params(dataset):
 
 def main_news(checkpoint_filename=None, dataset_params_filename=None, initial_epoch=1):
     """Main"""
-    dataset = DataSet(DATASET_FILENAME)
+    dataset = DataSet(DATASET_FILENAME, fresh_noise=FRESH_NOISE, cache_dirname=DATASET_CACHE_DIRECTORYNAME)
 
     if not os.path.exists(MODEL_CHECKPOINT_DIRECTORYNAME):
         os.makedirs(MODEL_CHECKPOINT_DIRECTORYNAME)
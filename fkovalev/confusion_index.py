@@ -0,0 +1,232 @@
+# coding: utf-8
+"""
+Precomputed real-word confusion sets, stored as memory-mapped numpy arrays.
+
+Words live in a sorted string table: utf-8 bytes concatenated in `<prefix>.strings.npy`, with their
+start offsets in `<prefix>.string_offsets.npy`. The neighbours of word i are the word indices
+neighbours[offsets[i]:offsets[i+1]], CSR style, in `<prefix>.offsets.npy` and
+`<prefix>.neighbours.npy`. When some strings only occur as neighbours, `<prefix>.keys.npy` marks
+the words that have a confusion set. Everything is opened with mmap_mode='r', so forked workers
+share the pages. Tables converted from a text file keep its size and mtime in `<prefix>.source.npy`,
+and are rebuilt once the file changes.
+
+    python confusion_index.py --dict /usr/share/dict/words --out words_confusion
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+CHARS = list(u"abcdefghijklmnopqrstuvwxyz")
+
+
+def edits1(word, alphabet):
+    s = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    deletes    = [a + b[1:] for a, b in s if b]
+    transposes = [a + b[1] + b[0] + b[2:] for a, b in s if len(b)>1]
+    replaces   = [a + c + b[1:] for a, b in s for c in alphabet if b]
+    inserts    = [a + c + b     for a, b in s for c in alphabet]
+    return set(deletes + transposes + replaces + inserts)
+
+
+def source_stamp(filename):
+    stat = os.stat(filename)
+    return np.array([stat.st_size, stat.st_mtime], dtype=np.float64)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _is_current(prefix, marker, source):
+    """Whether the table under prefix is complete and, given its source file, was built from the
+    file as it is now"""
+    if not os.path.exists(prefix + marker):
+        return False
+    if source is None:
+        return True
+    stamp_path = prefix + '.source.npy'
+    return os.path.exists(stamp_path) and np.array_equal(np.load(stamp_path), source_stamp(source))
+
+
+def _save_source(prefix, source):
+    if source is None:
+        _remove(prefix + '.source.npy')
+    else:
+        np.save(prefix + '.source.npy', source_stamp(source))
+
+
+class StringTable(object):
+    """Sorted unicode strings looked up by binary search over their utf-8 bytes. Recent lookups are
+    remembered, up to cache_size of them."""
+
+    def __init__(self, prefix, cache_size=100000):
+        self.data = np.load(prefix + '.strings.npy', mmap_mode='r')
+        self.offsets = np.load(prefix + '.string_offsets.npy', mmap_mode='r')
+        self.cache_size = cache_size
+        self.cache = {}
+
+    @staticmethod
+    def exists(prefix, source=None):
+        return _is_current(prefix, '.string_offsets.npy', source)
+
+    @staticmethod
+    def write(prefix, words, source=None):
+        """Write the words (unicode) sorted by their utf-8 bytes; returns them in table order. source
+        is the file they were read from, if any."""
+        # Removed first, so an interrupted rewrite does not look complete
+        _remove(prefix + '.string_offsets.npy')
+        encoded = sorted(set(w.encode('utf-8') for w in words))
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(w) for w in encoded])
+        np.save(prefix + '.strings.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        _save_source(prefix, source)
+        # Written last: its presence marks a complete table
+        np.save(prefix + '.string_offsets.npy', offsets)
+        return [w.decode('utf-8') for w in encoded]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def key(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tostring()
+
+    def __getitem__(self, i):
+        return self.key(i).decode('utf-8')
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def find(self, word):
+        """Index of word in the table, or -1"""
+        i = self.cache.get(word)
+        if i is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            i = self.cache[word] = self.search(word.encode('utf-8'))
+        return i
+
+    def search(self, key):
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.key(lo) == key:
+            return lo
+        return -1
+
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+
+class ConfusionIndex(object):
+    """word -> list of confusable words, read in place from the memory-mapped arrays"""
+
+    def __init__(self, prefix):
+        self.words = StringTable(prefix)
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        self.neighbours = np.load(prefix + '.neighbours.npy', mmap_mode='r')
+        self.keys = np.load(prefix + '.keys.npy', mmap_mode='r') if os.path.exists(prefix + '.keys.npy') else None
+        self.word_set = None
+
+    @staticmethod
+    def exists(prefix, source=None):
+        return _is_current(prefix, '.neighbours.npy', source)
+
+    @staticmethod
+    def write(prefix, confusion_sets, source=None):
+        """Write a dict of word -> list of words; the lists keep their order. source is the file
+        they were built from, if any."""
+        _remove(prefix + '.neighbours.npy')
+        words = StringTable.write(prefix, set(confusion_sets).union(*confusion_sets.values()), source)
+        word_index = dict((w, i) for i, w in enumerate(words))
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(confusion_sets.get(w, ())) for w in words])
+        neighbours = np.array([word_index[n] for w in words for n in confusion_sets.get(w, ())], dtype=np.int32)
+        if len(confusion_sets) < len(words):
+            np.save(prefix + '.keys.npy', np.array([w in confusion_sets for w in words], dtype=np.bool_))
+        else:
+            # Left over from an earlier index, it would hide words of this one
+            _remove(prefix + '.keys.npy')
+        np.save(prefix + '.offsets.npy', offsets)
+        # Written last: its presence marks a complete index
+        np.save(prefix + '.neighbours.npy', neighbours)
+
+    def find(self, word):
+        i = self.words.find(word)
+        if i >= 0 and self.keys is not None and not self.keys[i]:
+            return -1
+        return i
+
+    def lookup(self, i):
+        return [self.words[j] for j in self.neighbours[self.offsets[i]:self.offsets[i + 1]]]
+
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+    def __getitem__(self, word):
+        i = self.find(word)
+        if i < 0:
+            raise KeyError(word)
+        return self.lookup(i)
+
+    def real_word_errors(self, word):
+        """Real-word neighbours of word. Words outside the table fall back to edits1, intersected
+        with a set of the table's words built on first use."""
+        i = self.find(word)
+        if i >= 0:
+            return self.lookup(i)
+        if self.word_set is None:
+            self.word_set = set(self.words)
+        return sorted(self.word_set & edits1(word, CHARS))
+
+
+_WORDS = None
+
+
+def _neighbours(word):
+    return sorted(w for w in edits1(word, CHARS) if w in _WORDS)
+
+
+def build(words, prefix, processes=None, source=None):
+    """Build the edits1 real-word index of an iterable of unicode words, writing it under prefix.
+    source is the word list file, if any."""
+    global _WORDS
+    _WORDS = set(words)
+    words = sorted(_WORDS)
+    pool = multiprocessing.Pool(processes)
+    confusion_sets = {}
+    for i, (word, word_neighbours) in enumerate(itertools.izip(words, pool.imap(_neighbours, words, chunksize=1000))):
+        confusion_sets[word] = word_neighbours
+        if (i + 1) % 100000 == 0:
+            sys.stderr.write('%d words\n' % (i + 1))
+    pool.close()
+    pool.join()
+    _WORDS = None
+    ConfusionIndex.write(prefix, confusion_sets, source)
+
+
+def read_words(filename):
+    with open(filename) as f:
+        return [l.strip().decode('utf-8') for l in f if l.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the real-word confusion index of a word list.')
+    parser.add_argument('--dict', default='/usr/share/dict/words', help='Word list, one word per line.')
+    parser.add_argument('--out', default='words_confusion', help='Prefix of the index files.')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+    build(read_words(args.dict), args.out, args.processes, args.dict)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,24 @@
-
+# coding: utf-8
+import argparse
+import collections
+import itertools
+import multiprocessing
 import sys
 import regex
 import random
 import traceback
 
+import confusion_index
+
 ANY_CAPITAL = regex.compile('\p{Lu}')
-CHARS = list(u"abcdefghijklmnopqrstuvwxyz")
+CHARS = confusion_index.CHARS
+DICT_FILENAME = '/usr/share/dict/words'
+CONFUSION_INDEX = None
+INDEX = None
 DICT = None
 
-class ReTokenizer(object):
-    ANY_WORD = ur'[\p{L}\p{M}]+'
-    ANY_WORD_RE = regex.compile(ur'(?V1p)' + ANY_WORD + '$')
-    NUMBER = ur'[\p{N}]+'
-    NUMBER_RE = regex.compile(ur'(?V1p)' + NUMBER + '$')
-    SPACE = ur'[\p{Z}]+'
-    REST = ur'[^\p{Z}\p{L}\p{M}\p{N}]'
-    TOKENIZER_RE = regex.compile(ur'(?V1p)' + u'|'.join((ANY_WORD, SPACE, NUMBER, REST)))
-    SPACE_RE = regex.compile(ur'(?V1p)^' + SPACE + '$')
-    JOINER = u'￭'
-    JOINER_RE = regex.compile(ur'(?V1p) ￭ ')
-    
-    @classmethod
-    def tokenize(cls, sentence):
-        tokens = []
-        token_types = []
-        token_is_space = True
-        for w_it in cls.TOKENIZER_RE.finditer(sentence):
-            w = sentence[w_it.start():w_it.end()]
-            cur_token_is_space = True if cls.SPACE_RE.match(w) else False
-            if not token_is_space and not cur_token_is_space:
-                tokens.append(cls.JOINER)
-                token_types.append('J')
-            token_is_space = cur_token_is_space
-            if not cur_token_is_space:
-                tokens.append(w)
-                if cls.ANY_WORD_RE.match(w):
-                    token_types.append('W')
-                elif cls.NUMBER_RE.match(w):
-                    token_types.append('N')
-                else:
-                    token_types.append('R')
-        return tokens, token_types
-
-    @classmethod
-    def detokenize(cls, tokens):
-        words = u' '.join(tokens)
-        return cls.JOINER_RE.sub(u'', words)
-
-
-def get_random_word(line, min_size=1):
-    words = line.split(u' ')
+
+def get_random_word(words, min_size=1):
     counter = 0
     while True:
         # counter += 1
@@ -59,101 +28,116 @@ def get_random_word(line, min_size=1):
         rnd = random.randint(0, len(words) - 1)
         if len(words[rnd]) >= min_size:
             break
-    return words, rnd
+    return rnd
 
 
-def random_concat(line):
-    words = line.split(u' ')
+def max_word_len(words):
+    return max(len(w) for w in words)
+
+
+# The rules below take the line split on spaces and edit that list in place, so the line is split
+# once per noise pass instead of once per rule. Each rule draws the same random numbers as its
+# line-based original did, so a given seed produces the same output.
+
+def random_concat(words):
     rnd = random.randint(0, len(words) - 2)
     words[rnd:rnd+2] = [words[rnd] + words[rnd+1]]
-    return u' '.join(words)
 
-def random_split(line):
-    words, rnd1 = get_random_word(line, 2)
+def random_split(words):
+    rnd1 = get_random_word(words, 2)
     rnd2 = random.randint(1, len(words[rnd1]) - 1)
-    words[rnd1] = u' '.join((words[rnd1][:rnd2], words[rnd1][rnd2:]))
-    return u' '.join(words)
+    words[rnd1:rnd1+1] = [words[rnd1][:rnd2], words[rnd1][rnd2:]]
 
-def random_lowercase(line):
-    capitals = list(ANY_CAPITAL.finditer(line))
-    one_capital = random.choice(capitals)
-    return u''.join((line[:one_capital.start()], one_capital.group().lower(), line[one_capital.start()+1:]))
+def capitals(words):
+    return [(i, m) for i, w in enumerate(words) for m in ANY_CAPITAL.finditer(w)]
 
-def random_double_char(line):
-    words, rnd1 = get_random_word(line, 1)
+def random_lowercase(words, capital_positions):
+    i, one_capital = random.choice(capital_positions)
+    w = words[i]
+    words[i] = u''.join((w[:one_capital.start()], one_capital.group().lower(), w[one_capital.start()+1:]))
+
+def random_double_char(words):
+    rnd1 = get_random_word(words, 1)
     rnd2 = random.randint(0, len(words[rnd1]) - 1)
     words[rnd1] = u''.join((words[rnd1][:rnd2], words[rnd1][rnd2], words[rnd1][rnd2:]))
-    return u' '.join(words)
 
-def random_typo(line):
+def random_typo(words):
     rnd = random.random()
     # random delete
     if rnd < 0.25:
-        words, rnd1 = get_random_word(line, 1)
+        rnd1 = get_random_word(words, 1)
         rnd2 = random.randint(0, len(words[rnd1]) - 1)
         words[rnd1] = u''.join((words[rnd1][:rnd2-1], words[rnd1][rnd2:]))
-        return u' '.join(words)
+        return
     # random swap
-    if max(map(len, line.split(u' '))) >= 2 and rnd < 0.5:
-        words, rnd1 = get_random_word(line, 2)
+    if max_word_len(words) >= 2 and rnd < 0.5:
+        # The swapped word has always been discarded and a substitution made instead; only the
+        # random draws are kept, so seeded output does not change.
+        rnd1 = get_random_word(words, 2)
         rnd2 = random.randint(0, len(words[rnd1]) - 2)
-        words[rnd1] = u''.join((words[rnd1][:rnd2-1], words[rnd1][rnd2+1], words[rnd1][rnd2], words[rnd1][rnd2+1:]))
     # random substitute
     if rnd < 0.75:
         rndchr = random.choice(CHARS)
-        words, rnd1 = get_random_word(line, 1)
+        rnd1 = get_random_word(words, 1)
         rnd2 = random.randint(0, len(words[rnd1]))
         words[rnd1] = u''.join((words[rnd1][:rnd2-1], rndchr, words[rnd1][rnd2:]))
-        return u' '.join(words)
+        return
     # random add
-    words, rnd1 = get_random_word(line, 1)
+    rnd1 = get_random_word(words, 1)
     rnd2 = random.randint(0, len(words[rnd1]))
     rndchr = random.choice(CHARS)
     words[rnd1] = u''.join((words[rnd1][:rnd2], rndchr, words[rnd1][rnd2:]))
-    return u' '.join(words)
 
-def random_legal_word(line):
-    global DICT
-    if DICT is None:
-        DICT = set(line.strip() for line in open('/usr/share/dict/words'))
-    words, rnd = get_random_word(line, 2)
-    word = words[rnd]
-    possible_errors = DICT & edits1(word, CHARS)
+def load_confusion_index(prefix=None):
+    """Open the real-word confusion index of DICT_FILENAME under prefix, building it when it is
+    missing or older than the dictionary. Without a prefix nothing is written: the dictionary is read
+    into a set, which each word's edits1 is intersected with."""
+    global INDEX, DICT
+    if prefix is None:
+        DICT = set(confusion_index.read_words(DICT_FILENAME))
+        return
+    if not confusion_index.ConfusionIndex.exists(prefix, DICT_FILENAME):
+        sys.stderr.write('Building confusion index %s from %s\n' % (prefix, DICT_FILENAME))
+        confusion_index.build(confusion_index.read_words(DICT_FILENAME), prefix, source=DICT_FILENAME)
+    INDEX = confusion_index.ConfusionIndex(prefix)
+
+def real_word_errors(word):
+    if INDEX is None and DICT is None:
+        load_confusion_index(CONFUSION_INDEX)
+    if INDEX is not None:
+        return INDEX.real_word_errors(word)
+    return sorted(DICT & confusion_index.edits1(word, CHARS))
+
+def random_legal_word(words):
+    rnd = get_random_word(words, 2)
+    possible_errors = real_word_errors(words[rnd])
     if possible_errors:
-        words[rnd] = random.choice(list(possible_errors))
-    return u' '.join(words)
-
-
-def edits1(word, alphabet):
-    s = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-    deletes    = [a + b[1:] for a, b in s if b]
-    transposes = [a + b[1] + b[0] + b[2:] for a, b in s if len(b)>1]
-    replaces   = [a + c + b[1:] for a, b in s for c in alphabet if b]
-    inserts    = [a + c + b     for a, b in s for c in alphabet]
-    return set(deletes + transposes + replaces + inserts)
+        words[rnd] = random.choice(possible_errors)
 
 
 def add_noise_to_string(line):
+    words = line.split(u' ')
     no_mistakes = True
-    if ANY_CAPITAL.search(line) and random.random() < 0.3:
-        line = random_lowercase(line)
+    capital_positions = capitals(words)
+    if capital_positions and random.random() < 0.3:
+        random_lowercase(words, capital_positions)
         no_mistakes = False
-    if max(map(len, line.split(u' '))) >= 2 and random.random() < 0.1:
-        line = random_split(line)
+    if max_word_len(words) >= 2 and random.random() < 0.1:
+        random_split(words)
         no_mistakes = False
-    if len(line.split(u' ')) > 1 and random.random() < 0.2:
-        line = random_concat(line)
+    if len(words) > 1 and random.random() < 0.2:
+        random_concat(words)
         no_mistakes = False
     if random.random() < 0.2:
-        line = random_double_char(line)
+        random_double_char(words)
         no_mistakes = False
-    if max(map(len, line.split(u' '))) >= 2 and random.random() < 0.1:
-        line = random_legal_word(line)
+    if max_word_len(words) >= 2 and random.random() < 0.1:
+        random_legal_word(words)
         no_mistakes = False
     if no_mistakes or random.random() < 0.3:
-        line = random_typo(line)
+        random_typo(words)
         no_mistakes = False
-    return line
+    return u' '.join(words)
 
 
 def random_segment_line(line):
@@ -166,16 +150,74 @@ def random_segment_line(line):
     result.append(line)
     return result
 
+def noise_line(l):
+    snt = l.decode('utf-8').strip(u'\n')
+    res = []
+    for seg in random_segment_line(snt):
+        res.append(add_noise_to_string(seg))
+    line = u''.join(res).encode('utf-8')
+    # sys.stdout.write("\t".join((l, line)))
+    return line + "\n"
+
+
+def noise_chunk(args):
+    chunk_index, lines, base_seed = args
+    # Every chunk gets its own seed, so the output does not depend on the number of processes
+    random.seed(None if base_seed is None else base_seed + chunk_index)
+    return ''.join(noise_line(l) for l in lines)
+
+
+def read_chunks(f, chunk_size, base_seed):
+    for chunk_index, lines in enumerate(iter(lambda: list(itertools.islice(f, chunk_size)), [])):
+        yield chunk_index, lines, base_seed
+
+
+def noise_chunks(chunks, processes):
+    """Noise chunks in a process pool, yielding results in input order. At most a few chunks per
+    process are in flight, so memory stays bounded on endless input."""
+    pool = None
+    pending = collections.deque()
+    for chunk in chunks:
+        if pool is None:
+            # Loaded before the workers fork, so they share it instead of each building their own
+            load_confusion_index(CONFUSION_INDEX)
+            pool = multiprocessing.Pool(processes)
+        pending.append(pool.apply_async(noise_chunk, (chunk,)))
+        if len(pending) >= 2 * processes:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
 def main():
-    for l in sys.stdin:
-        snt = l.decode('utf-8').strip(u'\n')
-        res = []
-        for seg in random_segment_line(snt):
-            res.append(add_noise_to_string(seg))
-        line = u''.join(res).encode('utf-8')
-        # sys.stdout.write("\t".join((l, line)))
-        sys.stdout.write(line)
-        sys.stdout.write(u"\n")
+    global CONFUSION_INDEX
+    parser = argparse.ArgumentParser(description='Adds spelling mistakes to lines from stdin.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Worker processes; above 1 lines are noised in ordered chunks in parallel.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Base seed; chunk i is seeded with seed + i, for reproducible output.')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Lines per chunk.')
+    parser.add_argument('--confusion_index', default=None,
+                        help='Prefix of a real-word confusion index of %s, built there on first use if missing '
+                             'or stale. Without it the dictionary is held in memory.' % DICT_FILENAME)
+    args = parser.parse_args()
+    CONFUSION_INDEX = args.confusion_index
+
+    if args.processes <= 1 and args.seed is None:
+        for l in sys.stdin:
+            sys.stdout.write(noise_line(l))
+        return
+
+    chunks = read_chunks(sys.stdin, args.chunk_size, args.seed)
+    if args.processes <= 1:
+        results = itertools.imap(noise_chunk, chunks)
+    else:
+        results = noise_chunks(chunks, args.processes)
+    for result in results:
+        sys.stdout.write(result)
 
 
 if __name__ == '__main__':
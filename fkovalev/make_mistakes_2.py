@@ -3,50 +3,20 @@ import sys
 import regex
 import random
 import traceback
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+import re_tokenizer
 from collections import defaultdict
 
+from confusion_index import ConfusionIndex, StringTable
+
 ANY_CAPITAL = regex.compile('\p{Lu}')
 CHARS = list(u"abcdefghijklmnopqrstuvwxyz  ")
 DICT = None
+REPLACES_FILENAME = 'all_possible_replaces.txt'
+WORDS_FILENAME = 'words.txt'
 
-class ReTokenizer(object):
-    ANY_WORD = ur'[\p{L}\p{M}]+'
-    ANY_WORD_RE = regex.compile(ur'(?V1p)' + ANY_WORD + '$')
-    NUMBER = ur'[\p{N}]+'
-    NUMBER_RE = regex.compile(ur'(?V1p)' + NUMBER + '$')
-    SPACE = ur'[\p{Z}]+'
-    REST = ur'[^\p{Z}\p{L}\p{M}\p{N}]'
-    TOKENIZER_RE = regex.compile(ur'(?V1p)' + u'|'.join((ANY_WORD, SPACE, NUMBER, REST)))
-    SPACE_RE = regex.compile(ur'(?V1p)^' + SPACE + '$')
-    JOINER = u'￭'
-    JOINER_RE = regex.compile(ur'(?V1p)[ ]*￭[ ]*')
-    
-    @classmethod
-    def tokenize(cls, sentence):
-        tokens = []
-        token_types = []
-        token_is_space = True
-        for w_it in cls.TOKENIZER_RE.finditer(sentence):
-            w = sentence[w_it.start():w_it.end()]
-            cur_token_is_space = True if cls.SPACE_RE.match(w) else False
-            if not token_is_space and not cur_token_is_space:
-                tokens.append(cls.JOINER)
-                token_types.append('J')
-            token_is_space = cur_token_is_space
-            if not cur_token_is_space:
-                tokens.append(w)
-                if cls.ANY_WORD_RE.match(w):
-                    token_types.append('W')
-                elif cls.NUMBER_RE.match(w):
-                    token_types.append('N')
-                else:
-                    token_types.append('R')
-        return tokens, token_types
-
-    @classmethod
-    def detokenize(cls, tokens):
-        words = u' '.join(tokens)
-        return cls.JOINER_RE.sub(u'', words)
+ReTokenizer = re_tokenizer.ReTokenizer(joiner_re=ur'[ ]*￭[ ]*')
 
 def words_analyse(line, frequent_words, possible_replacment):
     tokens, token_types = ReTokenizer.tokenize(line)
@@ -147,18 +117,38 @@ def add_noise_to_string(line, frequent_words, possible_replacment):
 
 
 
-def main():
+def read_replaces(filename):
     all_possible_replaces = defaultdict(list)
-    f = open('all_possible_replaces.txt')
+    f = open(filename)
     for l in f:
         w, s = l.strip('\n').decode('utf-8').split(u'\t')
         for ws in s.split(u','):
             all_possible_replaces[w].append(ws)
+    return all_possible_replaces
+
+
+def read_words(filename):
     words = set()
-    f = open('words.txt')
+    f = open(filename)
     for l in f:
         w = l.strip('\n').decode('utf-8')
         words.add(w)
+    return words
+
+
+def load_confusion_sets(replaces_filename=REPLACES_FILENAME, words_filename=WORDS_FILENAME):
+    """Open the replacement graph and the frequent words as memory-mapped tables, converting the text
+    files on first use and again whenever they change. Lookups read the tables in place, so startup is
+    immediate and forked workers share the pages."""
+    if not ConfusionIndex.exists(replaces_filename, replaces_filename):
+        ConfusionIndex.write(replaces_filename, read_replaces(replaces_filename), replaces_filename)
+    if not StringTable.exists(words_filename, words_filename):
+        StringTable.write(words_filename, read_words(words_filename), words_filename)
+    return StringTable(words_filename), ConfusionIndex(replaces_filename)
+
+
+def main():
+    words, all_possible_replaces = load_confusion_sets()
 
     for l in sys.stdin:
         snt = l.decode('utf-8').strip(u'\n')
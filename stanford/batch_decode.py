@@ -0,0 +1,149 @@
+# Copyright 2016 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Correct a file of sentences with decode.fix_sents in several worker processes.
+
+The input is split into byte-range shards (nlc_data.file_shards). Each worker is a
+separate process with its own session and thread budget and decodes every
+processes-th shard into <output>.shardNNNNN. After each batch a shard's progress
+file records the input byte range of the shard and how many lines and bytes of it
+are done, so a rerun resumes where an interrupted run stopped. A shard whose range
+changed, as it does with another --shards or --processes, is decoded again from
+its start. Once all shards are complete they are concatenated into the output in
+input order.
+
+  python batch_decode.py --input dev.x.txt --output dev.fixed.txt --processes 8 \\
+      --train_dir ... --data_dir ... --lmfile ...
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from six.moves import xrange
+import tensorflow as tf
+
+import decode
+import nlc_data
+
+tf.app.flags.DEFINE_string("input", None, "File of sentences to correct, one per line.")
+tf.app.flags.DEFINE_string("output", None, "File the corrections are written to, in input order.")
+tf.app.flags.DEFINE_integer("processes", 4, "Number of decoding worker processes.")
+tf.app.flags.DEFINE_integer("shards", 0, "Number of input shards, the unit of resumption (default: 4 per process).")
+tf.app.flags.DEFINE_integer("threads_per_process", 0, "Intra- and inter-op threads of each worker's session (default: cores / processes).")
+tf.app.flags.DEFINE_integer("worker", -1, "Internal: run as the worker with this index.")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def shards():
+  return nlc_data.file_shards(FLAGS.input, FLAGS.shards or 4 * FLAGS.processes)
+
+
+def shard_path(i):
+  return "%s.shard%05d" % (FLAGS.output, i)
+
+
+def read_progress(i, shard):
+  """(lines, bytes) of shard i already decoded, or (0, 0) if its progress was recorded
+  for another (path, start, end) input range."""
+  path = shard_path(i) + ".progress"
+  if not os.path.exists(path):
+    return 0, 0
+  with open(path) as f:
+    fields = f.read().rstrip("\n").split(" ", 4)
+  if len(fields) != 5 or (fields[4], int(fields[2]), int(fields[3])) != shard:
+    print("Worker %d: shard %d was recorded for other input, decoding it again" % (FLAGS.worker, i))
+    return 0, 0
+  return int(fields[0]), int(fields[1])
+
+
+def write_progress(i, shard, lines, size):
+  path = shard_path(i) + ".progress"
+  input_path, start, end = shard
+  with open(path + ".tmp", "w") as f:
+    f.write("%d %d %d %d %s\n" % (lines, size, start, end, input_path))
+  # Renamed into place, so the progress file is never seen half written
+  os.rename(path + ".tmp", path)
+
+
+def decode_shard(model, sess, i, shard):
+  lines = [line.rstrip("\n") for line in nlc_data.shard_lines(*shard)]
+  done, size = read_progress(i, shard)
+  if done < len(lines):
+    print("Worker %d: shard %d, %d of %d lines done" % (FLAGS.worker, i, done, len(lines)))
+  with open(shard_path(i), "ab") as out:
+    # Drop whatever was written after the last recorded batch
+    out.truncate(size)
+    for batch_start in xrange(done, len(lines), FLAGS.batch_size):
+      batch = lines[batch_start:batch_start + FLAGS.batch_size]
+      out.write("".join(fixed + "\n" for fixed in decode.fix_sents(model, sess, batch)))
+      out.flush()
+      os.fsync(out.fileno())
+      write_progress(i, shard, batch_start + len(batch), out.tell())
+
+
+def work():
+  threads = FLAGS.threads_per_process or max(multiprocessing.cpu_count() // FLAGS.processes, 1)
+  config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+  with tf.Session(config=config) as sess:
+    model = decode.load(sess)
+    for i, shard in enumerate(shards()):
+      if i % FLAGS.processes == FLAGS.worker:
+        decode_shard(model, sess, i, shard)
+
+
+def merge(num_shards):
+  with open(FLAGS.output + ".tmp", "wb") as out:
+    for i in xrange(num_shards):
+      with open(shard_path(i), "rb") as f:
+        shutil.copyfileobj(f, out)
+  os.rename(FLAGS.output + ".tmp", FLAGS.output)
+  for i in xrange(num_shards):
+    os.remove(shard_path(i))
+    if os.path.exists(shard_path(i) + ".progress"):
+      os.remove(shard_path(i) + ".progress")
+
+
+def run():
+  num_shards = len(shards())
+  # Prepared here once, rather than by every worker at the same time
+  decode.load_vocab()
+  tic = time.time()
+  args = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+  workers = [subprocess.Popen(args + ["--worker=%d" % k]) for k in xrange(min(FLAGS.processes, num_shards))]
+  failed = [k for k, worker in enumerate(workers) if worker.wait() != 0]
+  if failed:
+    print("Workers %s failed; rerun the same command to resume" % failed)
+    sys.exit(1)
+  merge(num_shards)
+  print("Decoded %d shards with %d processes in %f secs" % (num_shards, len(workers), time.time() - tic))
+
+
+def main(_):
+  if FLAGS.worker >= 0:
+    work()
+  else:
+    run()
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,86 @@
+# Copyright 2016 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Compare the cold start of decode.load from the checkpoint and from a frozen graph.
+
+Every run is a fresh process that loads the model and corrects one sentence,
+reporting the time to load, the time to the first correction and its peak
+resident memory. The medians of --benchmark_runs runs per mode are printed.
+
+  python benchmark_startup.py --train_dir ... --data_dir ... --frozen_graph model.pb
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+from six.moves import xrange
+import tensorflow as tf
+
+import decode
+
+tf.app.flags.DEFINE_integer("benchmark_runs", 3, "Fresh processes started per mode.")
+tf.app.flags.DEFINE_string("benchmark_sentence", "Thsi is a sentense with erors.", "Sentence corrected after loading.")
+tf.app.flags.DEFINE_boolean("benchmark_child", False, "Internal: load and decode once, printing the measurements.")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def child():
+  tic = time.time()
+  with tf.Session() as sess:
+    model = decode.load(sess)
+    loaded = time.time()
+    decode.fix_sent(model, sess, FLAGS.benchmark_sentence)
+    done = time.time()
+  # ru_maxrss is in kilobytes on Linux
+  print(json.dumps({"load": loaded - tic, "first": done - tic,
+                    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}))
+
+
+def run(frozen_graph):
+  args = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--benchmark_child"]
+  # Given last, so it overrides the --frozen_graph of the command line
+  args.append("--frozen_graph=%s" % (frozen_graph or ""))
+  tic = time.time()
+  output = subprocess.check_output(args)
+  result = json.loads(output.strip().splitlines()[-1])
+  result["process"] = time.time() - tic
+  return result
+
+
+def main(_):
+  if FLAGS.benchmark_child:
+    child()
+    return
+  frozen_graph = FLAGS.frozen_graph
+  modes = [("checkpoint", None)] + ([("frozen", frozen_graph)] if frozen_graph else [])
+  print("%-10s %10s %12s %10s %10s" % ("mode", "load (s)", "first (s)", "total (s)", "RSS (MB)"))
+  for name, graph in modes:
+    results = [run(graph) for _ in xrange(FLAGS.benchmark_runs)]
+    median = lambda key: np.median([r[key] for r in results])
+    print("%-10s %10.2f %12.2f %10.2f %10.1f" % (name, median("load"), median("first"), median("process"),
+                                                  median("rss_mb")))
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -31,9 +31,12 @@ import tensorflow as tf
 
 import kenlm
 
+import freeze
 import nlc_model
 import nlc_data
+from lm_scorer import LMScorer
 from util import get_tokenizer
+from util import padded
 
 tf.app.flags.DEFINE_float("learning_rate", 0.001, "Learning rate.")
 tf.app.flags.DEFINE_float("learning_rate_decay_factor", 0.95, "Learning rate decays by this much.")
@@ -51,6 +54,8 @@ tf.app.flags.DEFINE_string("tokenizer", "CHAR", "Set to WORD to train word level
 tf.app.flags.DEFINE_integer("beam_size", 8, "Size of beam.")
 tf.app.flags.DEFINE_string("lmfile", None, "arpa file of the language model.")
 tf.app.flags.DEFINE_float("alpha", 0.3, "Language model relative weight.")
+tf.app.flags.DEFINE_string("frozen_graph", None, "Frozen inference graph (see freeze.py) to load instead of building the model and restoring the checkpoint.")
+tf.app.flags.DEFINE_string("export_frozen", None, "Write the checkpoint as a frozen inference graph to this file and exit.")
 
 FLAGS = tf.app.flags.FLAGS
 reverse_vocab, vocab = None, None
@@ -86,6 +91,18 @@ def tokenize(sent, vocab, depth=FLAGS.num_layers):
   return source, mask
 
 
+def tokenize_batch(sents, vocab, depth=FLAGS.num_layers):
+  token_ids = [nlc_data.sentence_to_token_ids(sent, vocab, get_tokenizer(FLAGS)) for sent in sents]
+  return batch_arrays(token_ids, depth)
+
+
+def batch_arrays(token_ids, depth=FLAGS.num_layers):
+  source = np.array(padded(token_ids, depth)).T
+  mask = (source != nlc_data.PAD_ID).astype(np.int32)
+
+  return source, mask
+
+
 def detokenize(sents, reverse_vocab):
   # TODO: char vs word
   def detok_sent(sent):
@@ -101,7 +118,7 @@ def lm_rank(strs, probs):
   if lm is None:
     return strs[0]
   a = FLAGS.alpha
-  lmscores = [lm.score(s)/(1+len(s.split())) for s in strs]
+  lmscores = [l/(1+len(s.split())) for (s, l) in zip(strs, lm.score_all(strs))]
   probs = [ p / (len(s)+1) for (s, p) in zip(strs, probs) ]
   for (s, p, l) in zip(strs, probs, lmscores):
     print(s, p, l)
@@ -121,31 +138,38 @@ def lm_rank(strs, probs):
 #  rerank = [rs[0] for rs in sorted(enumerate(rescores), key=lambda x:x[1])]
 #  return strs[rerank[-1]]
 
-def decode_beam(model, sess, encoder_output, max_beam_size):
-  toks, probs = model.decode_beam(sess, encoder_output, beam_size=max_beam_size)
+def decode_beam(model, sess, encoder_output, max_beam_size, source_mask=None):
+  toks, probs = model.decode_beam(sess, encoder_output, beam_size=max_beam_size, source_mask=source_mask)
   return toks.tolist(), probs.tolist()
 
-def fix_sent(model, sess, sent):
+def fix_sents(model, sess, sents):
   # Tokenize
-  input_toks, mask = tokenize(sent, vocab)
+  token_ids = [nlc_data.sentence_to_token_ids(sent, vocab, get_tokenizer(FLAGS)) for sent in sents]
+  # Sentences without tokens, such as blank lines, come back empty: a batch of only those
+  # would give the encoder a zero-length source
+  kept = [i for i, ids in enumerate(token_ids) if ids]
+  best_strs = [""] * len(sents)
+  if not kept:
+    return best_strs
+  input_toks, mask = batch_arrays([token_ids[i] for i in kept])
   # Encode
   encoder_output = model.encode(sess, input_toks, mask)
-  # Decode
-  beam_toks, probs = decode_beam(model, sess, encoder_output, FLAGS.beam_size)
-  # De-tokenize
-  beam_strs = detokenize(beam_toks, reverse_vocab)
-  # Language Model ranking
-  best_str = lm_rank(beam_strs, probs)
+  # Decode every sentence's beam in one pass
+  beam_toks, probs = decode_beam(model, sess, encoder_output, FLAGS.beam_size, mask)
+  for i, toks, sent_probs in zip(kept, beam_toks, probs):
+    # De-tokenize
+    beam_strs = detokenize(toks, reverse_vocab)
+    # Language Model ranking
+    best_strs[i] = lm_rank(beam_strs, sent_probs)
   # Return
-  return best_str
+  return best_strs
 
-def decode():
-  # Prepare NLC data.
-  global reverse_vocab, vocab, lm
+def fix_sent(model, sess, sent):
+  return fix_sents(model, sess, [sent])[0]
 
-  if FLAGS.lmfile is not None:
-    print("Loading Language model from %s" % FLAGS.lmfile)
-    lm = kenlm.LanguageModel(FLAGS.lmfile)
+def load_vocab():
+  # Prepare NLC data and read its vocabulary.
+  global reverse_vocab, vocab
 
   print("Preparing NLC data in %s" % FLAGS.data_dir)
 
@@ -153,12 +177,35 @@ def decode():
     FLAGS.data_dir + '/' + FLAGS.tokenizer.lower(), FLAGS.max_vocab_size,
     tokenizer=get_tokenizer(FLAGS))
   vocab, reverse_vocab = nlc_data.initialize_vocabulary(vocab_path)
+
+def load(sess):
+  # Prepare NLC data, the language model and the network once per process.
+  global lm
+
+  if FLAGS.lmfile is not None:
+    print("Loading Language model from %s" % FLAGS.lmfile)
+    lm = LMScorer(kenlm.LanguageModel(FLAGS.lmfile))
+
+  load_vocab()
   vocab_size = len(vocab)
   print("Vocabulary size: %d" % vocab_size)
 
+  if FLAGS.frozen_graph:
+    print("Loading frozen graph from %s" % FLAGS.frozen_graph)
+    return freeze.FrozenNLCModel(FLAGS.frozen_graph)
+
+  print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
+  return create_model(sess, vocab_size, True)
+
+def export_frozen():
   with tf.Session() as sess:
-    print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
-    model = create_model(sess, vocab_size, False)
+    load_vocab()
+    model = create_model(sess, len(vocab), True)
+    freeze.export(sess, model, FLAGS.export_frozen)
+
+def decode():
+  with tf.Session() as sess:
+    model = load(sess)
 
     while True:
       sent = raw_input("Enter a sentence: ")
@@ -168,7 +215,10 @@ def decode():
       print("Candidate: ", output_sent)
 
 def main(_):
-  decode()
+  if FLAGS.export_frozen is not None:
+    export_frozen()
+  else:
+    decode()
 
 if __name__ == "__main__":
   tf.app.run()
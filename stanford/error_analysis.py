@@ -28,6 +28,7 @@ import string
 import numpy as np
 from six.moves import xrange
 import tensorflow as tf
+import contextlib
 import csv
 import itertools
 import json
@@ -37,6 +38,8 @@ import kenlm
 
 import nlc_model
 import nlc_data
+import nbest
+from lm_scorer import LMScorer
 from util import pair_iter
 from util import get_tokenizer
 import subprocess
@@ -49,22 +52,28 @@ tf.app.flags.DEFINE_integer("beam_size", 8, "Size of beam.")
 tf.app.flags.DEFINE_float("alpha", 0.3, "Language model relative weight.")
 tf.app.flags.DEFINE_boolean("sweep", False, "sweep all alpha rates with dev turned on")
 tf.app.flags.DEFINE_boolean("score", False, "generate csv with language model scores on target and generated.")
+tf.app.flags.DEFINE_string("nbest_cache", None, "npz file caching the dev set n-best lists and scores for --sweep, decoded again if missing or decoded from another checkpoint, LM, dev set or vocabulary (default: train_dir/nbest_beam<beam_size>.npz).")
+tf.app.flags.DEFINE_string("nbest_out", None, "Prefix of binary n-best lists (see nbest.py) to write the decoded dev set to.")
+tf.app.flags.DEFINE_integer("sweep_alphas", 11, "Number of evenly spaced alpha values in [0, 1] evaluated by --sweep.")
 
 FLAGS = tf.app.flags.FLAGS
 
 reverse_vocab, vocab = None, None
 lm = None
 
+def checkpoint_path():
+  ckpt_paths = [f for f in os.listdir(FLAGS.train_dir) if (re.search(r"best\.ckpt-\d+", f)\
+          and not f.endswith("meta"))]
+  assert(len(ckpt_paths) > 0)
+  ckpt_paths = sorted(ckpt_paths, key=lambda x: int(x.split("-")[-1]))
+  return os.path.join(FLAGS.train_dir, ckpt_paths[-1])
+
 def create_model(session, vocab_size, forward_only):
   model = nlc_model.NLCModel(
       vocab_size, FLAGS.size, FLAGS.num_layers, FLAGS.max_gradient_norm, FLAGS.batch_size,
       FLAGS.learning_rate, FLAGS.learning_rate_decay_factor, FLAGS.dropout,
       forward_only=forward_only)
-  ckpt_paths = [f for f in os.listdir(FLAGS.train_dir) if (re.search(r"best\.ckpt-\d+", f)\
-          and not f.endswith("meta"))]
-  assert(len(ckpt_paths) > 0)
-  ckpt_paths = sorted(ckpt_paths, key=lambda x: int(x.split("-")[-1]))
-  ckpt_path = os.path.join(FLAGS.train_dir, ckpt_paths[-1])
+  ckpt_path = checkpoint_path()
   if tf.gfile.Exists(ckpt_path):
     print("Reading model parameters from %s" % ckpt_path)
     model.saver.restore(session, ckpt_path)
@@ -87,16 +96,6 @@ def detokenize(sents, reverse_vocab):
     return outsent
   return [detok_sent(s) for s in sents]
 
-def network_score(model, sess, encoder_output, target_tokens):
-  score = 0.0
-  states = None
-  cnt = 0
-  for (feed, pick) in zip(list(target_tokens)[:-1], list(target_tokens)[1:]):
-    scores, _, states = model.decode(sess, encoder_output, np.array([feed]), None, states)
-    score += float(scores[0, 0, pick])
-    cnt += 1
-  return score / cnt
-
 def detokenize_tgt(toks, reverse_vocab):
   outsent = ''
   for i in range(toks.shape[0]):
@@ -114,7 +113,7 @@ def lm_rank(strs, probs):
   if lm is None:
     return strs[0]
   a = FLAGS.alpha
-  lmscores = [lm.score(s)/(1+len(s.split())) for s in strs]
+  lmscores = [l/(1+len(s.split())) for (s, l) in zip(strs, lm.score_all(strs))]
   probs = [ p / (len(s)+1) for (s, p) in zip(strs, probs) ]
   #for (s, p, l) in zip(strs, probs, lmscores):
     #print(s, p, l)
@@ -138,7 +137,7 @@ def lm_rank_score(strs, probs):
   if lm is None:
     return strs[0]
   a = FLAGS.alpha
-  lmscores = [lm.score(s)/(1+len(s.split())) for s in strs]
+  lmscores = [l/(1+len(s.split())) for (s, l) in zip(strs, lm.score_all(strs))]
   probs = [ p / (len(s)+1) for (s, p) in zip(strs, probs) ]
   rescores = [(1 - a) * p + a * l for (l, p) in zip(lmscores, probs)]
   rerank = [rs[0] for rs in sorted(enumerate(rescores), key=lambda x: x[1])]
@@ -148,17 +147,30 @@ def lm_rank_score(strs, probs):
   score = rescores[rerank[-1]]
   return generated, score, nw_score, lm_score
 
-def decode_beam(model, sess, encoder_output, max_beam_size):
-  toks, probs = model.decode_beam(sess, encoder_output, beam_size=max_beam_size)
+def decode_beam(model, sess, encoder_output, max_beam_size, source_mask=None):
+  toks, probs = model.decode_beam(sess, encoder_output, beam_size=max_beam_size, source_mask=source_mask)
   return toks.tolist(), probs.tolist()
 
 def setup_batch_decode(sess):
   # decode for dev-sets, in batches
-  global reverse_vocab, vocab, lm
+  load_lm()
+  x_dev, y_dev, vocab_path = setup_data()
+
+  print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
+  model = create_model(sess, len(vocab), True)
 
+  return model, x_dev, y_dev
+
+
+def load_lm():
+  global lm
   if FLAGS.lmfile is not None:
     print("Loading Language model from %s" % FLAGS.lmfile)
-    lm = kenlm.LanguageModel(FLAGS.lmfile)
+    lm = LMScorer(kenlm.LanguageModel(FLAGS.lmfile))
+
+
+def setup_data():
+  global reverse_vocab, vocab
 
   print("Preparing NLC data in %s" % FLAGS.data_dir)
 
@@ -166,13 +178,9 @@ def setup_batch_decode(sess):
     FLAGS.data_dir + '/' + FLAGS.tokenizer.lower(), FLAGS.max_vocab_size,
     tokenizer=get_tokenizer(FLAGS), other_dev_path="/deep/group/nlp_data/nlc_data/ourdev/bpe")
   vocab, reverse_vocab = nlc_data.initialize_vocabulary(vocab_path, bpe=(FLAGS.tokenizer.lower()=="bpe"))
-  vocab_size = len(vocab)
-  print("Vocabulary size: %d" % vocab_size)
+  print("Vocabulary size: %d" % len(vocab))
 
-  print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
-  model = create_model(sess, vocab_size, False)
-
-  return model, x_dev, y_dev
+  return x_dev, y_dev, vocab_path
 
 
 def batch_decode(model, sess, x_dev, y_dev, alpha):
@@ -187,59 +195,201 @@ def batch_decode(model, sess, x_dev, y_dev, alpha):
     target_nw_score = [];
 
     count = 0
-    for source_tokens, source_mask, target_tokens, target_mask in pair_iter(x_dev, y_dev, 1,
-                                                                            FLAGS.num_layers, sort_and_shuffle=False):
-      src_sent = detokenize_tgt(source_tokens, reverse_vocab)
-      tgt_sent = detokenize_tgt(target_tokens, reverse_vocab)
-
-      # Encode
+    with open_nbest_writer() as nbest_writer:
+      for source_tokens, source_mask, target_tokens, target_mask, line_numbers in pair_iter(
+          x_dev, y_dev, FLAGS.batch_size, FLAGS.num_layers, sort_and_shuffle=False, line_numbers=True):
+        # Encode
+        encoder_output = model.encode(sess, source_tokens, source_mask)
+        # Decode
+        batch_toks, batch_probs = decode_beam(model, sess, encoder_output, FLAGS.beam_size, source_mask)
+        if nbest_writer:
+          nbest_writer.write_batch(batch_toks, batch_probs, line_numbers)
+        # Score the references of the whole batch in one pass
+        _, tgt_nw_scores = model.score_batch(sess, source_tokens, source_mask, target_tokens, target_mask)
+
+        for i, (beam_toks, probs) in enumerate(zip(batch_toks, batch_probs)):
+          src_sent = detokenize_tgt(source_tokens[:, i:i+1], reverse_vocab)
+          tgt_sent = detokenize_tgt(target_tokens[:, i:i+1], reverse_vocab)
+
+          # De-tokenize
+          beam_strs = detokenize(beam_toks, reverse_vocab)
+          tgt_nw_score = float(tgt_nw_scores[i])
+          print("pair: %d network score: %f" % (count+1, tgt_nw_score))
+          # Language Model ranking
+          if not FLAGS.score:
+            best_str = lm_rank(beam_strs, probs)
+          else:
+            best_str, rerank_score, nw_score, lm_score = lm_rank_score(beam_strs, probs)
+            tgt_lm_score = lm.score(tgt_sent) / len(tgt_sent.split())
+
+          print("%s | %s | %s" % (src_sent, tgt_sent, best_str))
+
+          # see if this is too stupid, or doesn't work at all
+          error_source.append(src_sent)
+          error_target.append(tgt_sent)
+          error_generated.append(best_str)
+          if FLAGS.score:
+            target_lm_score.append(tgt_lm_score)
+            target_nw_score.append(tgt_nw_score)
+            generated_score.append(rerank_score)
+            generated_nw_score.append(nw_score)
+            generated_lm_score.append(lm_score)
+          count += 1
+
+    if FLAGS.score:
+      write_scores_csv(alpha, error_source, error_target, target_nw_score, target_lm_score, error_generated, generated_score,
+                       generated_nw_score, generated_lm_score)
+
+    write_generated(alpha, error_generated)
+
+
+@contextlib.contextmanager
+def open_nbest_writer():
+  """An n-best writer to FLAGS.nbest_out for the sentences about to be decoded, or None.
+  The lists are completed when the block exits and discarded if it raises."""
+  if FLAGS.nbest_out is None:
+    yield None
+    return
+  print("Writing n-best lists to %s" % FLAGS.nbest_out)
+  with nbest.NBestWriter(FLAGS.nbest_out, len(vocab)) as writer:
+    yield writer
+
+
+def write_scores_csv(alpha, *columns):
+  print("outputting in csv file...")
+
+  # dump it out in train_dir
+  with open("err_val_alpha_" + str(alpha) + ".csv", 'wb') as f:
+    wrt = csv.writer(f)
+    wrt.writerow(['Bad Input', 'Ground Truth', 'Network Score', 'LM Score', 'Generated Hypothesis', 'Combined Score', 'Network Score', 'LM Score'])
+    for row in itertools.izip(*columns):
+      wrt.writerow(list(row))
+
+  print("err_val_alpha_" + str(alpha) + ".csv" + " file finished")
+
+
+def write_generated(alpha, generated):
+  with open(FLAGS.tokenizer.lower() + "_runs" + str(FLAGS.beam_size) + "/alpha" + str(alpha) + ".txt", 'wb') as f:
+    f.write("\n".join(generated))
+
+
+def decode_nbest(model, sess, x_dev, y_dev):
+  """Decode the dev set once, returning its n-best lists as arrays: the candidates
+  (padded with '' to the largest beam, counts gives the real sizes), their network and
+  LM scores normalized as lm_rank normalizes them, and the scores of the targets."""
+  sources, targets, candidates, counts = [], [], [], []
+  nw_scores, lm_scores, target_nw_scores, target_lm_scores = [], [], [], []
+  with open_nbest_writer() as nbest_writer:
+    for source_tokens, source_mask, target_tokens, target_mask, line_numbers in pair_iter(
+        x_dev, y_dev, FLAGS.batch_size, FLAGS.num_layers, sort_and_shuffle=False, line_numbers=True):
       encoder_output = model.encode(sess, source_tokens, source_mask)
-      # Decode
-      beam_toks, probs = decode_beam(model, sess, encoder_output, FLAGS.beam_size)
-      # De-tokenize
-      beam_strs = detokenize(beam_toks, reverse_vocab)
-      tgt_nw_score = network_score(model, sess, encoder_output, target_tokens)
-      print("pair: %d network score: %f" % (count+1, tgt_nw_score))
-      # Language Model ranking
-      if not FLAGS.score:
-        best_str = lm_rank(beam_strs, probs)
-      else:
-        best_str, rerank_score, nw_score, lm_score = lm_rank_score(beam_strs, probs)
-        tgt_lm_score = lm.score(tgt_sent) / len(tgt_sent.split())
-
-      print("%s | %s | %s" % (src_sent, tgt_sent, best_str))
-
-      # see if this is too stupid, or doesn't work at all
-      error_source.append(src_sent)
-      error_target.append(tgt_sent)
-      error_generated.append(best_str)
-      if FLAGS.score:
-        target_lm_score.append(tgt_lm_score)
-        target_nw_score.append(tgt_nw_score)
-        generated_score.append(rerank_score)
-        generated_nw_score.append(nw_score)
-        generated_lm_score.append(lm_score)
-      count += 1
-
-    """
-    print("outputting in csv file...")
-
-    # dump it out in train_dir
-    with open("err_val_alpha_" + str(alpha) + ".csv", 'wb') as f:
-      wrt = csv.writer(f)
-      wrt.writerow(['Bad Input', 'Ground Truth', 'Network Score', 'LM Score', 'Generated Hypothesis', 'Combined Score', 'Network Score', 'LM Score'])
-      if not FLAGS.score:
-        for s, t, g in itertools.izip(error_source, error_target, error_generated):
-          wrt.writerow([s, t, g])  # source, correct target, wrong target
-      else:
-        for s, t, tns, tls, g, gs, gns, gls in itertools.izip(error_source, error_target, target_nw_score, target_lm_score, error_generated, generated_score, generated_nw_score, generated_lm_score):
-          wrt.writerow([s, t, tns, tls, g, gs, gns, gls])
-    """
-
-    #print("err_val_alpha_" + str(alpha) + ".csv" + "file finished")
-
-    with open(FLAGS.tokenizer.lower() + "_runs" + str(FLAGS.beam_size) + "/alpha" + str(alpha) + ".txt", 'wb') as f:
-      f.write("\n".join(error_generated))
+      batch_toks, batch_probs = decode_beam(model, sess, encoder_output, FLAGS.beam_size, source_mask)
+      if nbest_writer:
+        nbest_writer.write_batch(batch_toks, batch_probs, line_numbers)
+      _, tgt_nw_scores = model.score_batch(sess, source_tokens, source_mask, target_tokens, target_mask)
+
+      for i, (beam_toks, probs) in enumerate(zip(batch_toks, batch_probs)):
+        tgt_sent = detokenize_tgt(target_tokens[:, i:i+1], reverse_vocab)
+        beam_strs = detokenize(beam_toks, reverse_vocab)
+        sources.append(detokenize_tgt(source_tokens[:, i:i+1], reverse_vocab))
+        targets.append(tgt_sent)
+        candidates.append(beam_strs)
+        counts.append(len(beam_strs))
+        nw_scores.append([p / (len(s)+1) for (s, p) in zip(beam_strs, probs)])
+        target_nw_scores.append(float(tgt_nw_scores[i]))
+        if lm is None:
+          lm_scores.append([0.0] * len(beam_strs))
+          target_lm_scores.append(float("nan"))
+        else:
+          lm_scores.append([l/(1+len(s.split())) for (s, l) in zip(beam_strs, lm.score_all(beam_strs))])
+          target_lm_scores.append(lm.score(tgt_sent) / max(len(tgt_sent.split()), 1))
+      print("decoded %d sentences" % len(targets))
+
+  width = max(counts)
+  pad = lambda rows, value: [list(row) + [value] * (width - len(row)) for row in rows]
+  return {"sources": np.array(sources), "targets": np.array(targets), "candidates": np.array(pad(candidates, "")),
+          "counts": np.array(counts), "nw_scores": np.array(pad(nw_scores, 0.0)), "lm_scores": np.array(pad(lm_scores, 0.0)),
+          "target_nw_scores": np.array(target_nw_scores), "target_lm_scores": np.array(target_lm_scores),
+          "has_lm": np.array(lm is not None)}
+
+
+def nbest_sources(x_dev, y_dev, vocab_path):
+  """What the dev set n-best cache is decoded from, as strings stored in the cache and
+  compared when it is read again: the checkpoint, the LM, the beam size, the dev files and
+  the vocabulary and tokenizer that map them to token ids"""
+  def file_id(path):
+    stat = os.stat(path)
+    return "%s %d %d" % (os.path.abspath(path), stat.st_size, int(stat.st_mtime))
+  return {"source_checkpoint": os.path.abspath(checkpoint_path()),
+          "source_lmfile": os.path.abspath(FLAGS.lmfile) if FLAGS.lmfile else "",
+          "source_beam_size": str(FLAGS.beam_size),
+          "source_x_dev": file_id(x_dev), "source_y_dev": file_id(y_dev),
+          "source_vocab": file_id(vocab_path), "source_tokenizer": FLAGS.tokenizer.lower()}
+
+
+def load_nbest(sess):
+  """The dev set n-best cache, decoding and LM-scoring the dev set into it if it does not exist
+  yet or was decoded from another checkpoint, LM, beam size, dev set, vocabulary or tokenizer"""
+  path = FLAGS.nbest_cache or os.path.join(FLAGS.train_dir, "nbest_beam%d.npz" % FLAGS.beam_size)
+  x_dev, y_dev, vocab_path = setup_data()
+  sources = nbest_sources(x_dev, y_dev, vocab_path)
+  if os.path.exists(path):
+    with np.load(path) as cache:
+      nbest = dict(cache.items())
+    changed = [key for key in sorted(sources) if key not in nbest or str(nbest[key]) != sources[key]]
+    if not changed:
+      print("Reading n-best lists from %s" % path)
+      return nbest
+    print("Decoding again, %s does not match %s" % (path, ", ".join(key[len("source_"):] for key in changed)))
+  load_lm()
+  print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
+  model = create_model(sess, len(vocab), True)
+  nbest = decode_nbest(model, sess, x_dev, y_dev)
+  nbest.update((key, np.array(value)) for key, value in sources.items())
+  # Renamed into place once complete, so an interrupted run does not leave a partial cache
+  with open(path + ".tmp", "wb") as f:
+    np.savez(f, **nbest)
+  os.rename(path + ".tmp", path)
+  print("Wrote n-best lists to %s" % path)
+  return nbest
+
+
+def rerank_nbest(nbest, alpha):
+  """Index of the best candidate of every sentence at alpha, as lm_rank picks it:
+  the last of the candidates with the highest combined score"""
+  counts = nbest["counts"]
+  if not nbest["has_lm"]:
+    return np.zeros(len(counts), dtype=np.int64)
+  width = nbest["nw_scores"].shape[1]
+  rescores = (1 - alpha) * nbest["nw_scores"] + alpha * nbest["lm_scores"]
+  rescores[np.arange(width)[None, :] >= counts[:, None]] = -np.inf
+  return width - 1 - np.argmax(rescores[:, ::-1], axis=1)
+
+
+def sweep_alphas(count):
+  """count evenly spaced alphas in [0, 1]; 0 and 1 stay ints, so the default of 11 is the
+  old [0, 0.1, ..., 1] grid and the output file names (alpha0.txt, alpha0.1.txt, ...) are unchanged"""
+  return [int(a) if a in (0, 1) else round(a, 6) for a in np.linspace(0, 1, count)]
+
+
+def sweep_nbest(nbest, alphas):
+  """Rerank the cached n-best lists at every alpha, writing the outputs batch_decode
+  writes and reporting the exact-match accuracy against the targets"""
+  rows = np.arange(len(nbest["targets"]))
+  accuracies = []
+  for alpha in alphas:
+    best = rerank_nbest(nbest, alpha)
+    generated = nbest["candidates"][rows, best]
+    accuracies.append(np.mean(generated == nbest["targets"]))
+    print("alpha = %s: exact match accuracy %f" % (alpha, accuracies[-1]))
+    if FLAGS.score:
+      nw_scores = nbest["nw_scores"][rows, best]
+      lm_scores = nbest["lm_scores"][rows, best]
+      write_scores_csv(alpha, nbest["sources"], nbest["targets"], nbest["target_nw_scores"], nbest["target_lm_scores"],
+                       generated, (1 - alpha) * nw_scores + alpha * lm_scores, nw_scores, lm_scores)
+    write_generated(alpha, generated)
+  best_alpha = int(np.argmax(accuracies))
+  print("best alpha = %s: exact match accuracy %f" % (alphas[best_alpha], accuracies[best_alpha]))
 
 
 def main(_):
@@ -252,12 +402,9 @@ def main(_):
 
   with tf.Session() as sess:
     if FLAGS.sweep:
-      alpha = [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]
-      model, x_dev, y_dev = setup_batch_decode(sess)
-      for a in alpha:
-        FLAGS.alpha = a
-        print("ranking with alpha = " + str(FLAGS.alpha))
-        batch_decode(model, sess, x_dev, y_dev, a)
+      # Decoded and LM-scored once; every alpha only reranks the cached n-best lists
+      alphas = sweep_alphas(FLAGS.sweep_alphas)
+      sweep_nbest(load_nbest(sess), alphas)
     else:
       model, x_dev, y_dev = setup_batch_decode(sess)
       print("ranking with alpha = " + str(FLAGS.alpha))
@@ -0,0 +1,97 @@
+# Copyright 2016 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Export a checkpoint as a frozen inference graph, and load it back.
+
+The exported graph is the forward-only NLCModel pruned to the encoder, beam
+search and target scoring outputs, with every variable replaced by a constant
+holding its checkpoint value, so loading it needs no model construction and no
+Saver restore. <path> is the serialized GraphDef and <path>.json names its
+input and output tensors. Incremental decoding (prime_step / decode_step) keeps
+state in variables and is not part of the export.
+
+  python decode.py --train_dir ... --data_dir ... --export_frozen model.pb
+  python decode.py --train_dir ... --data_dir ... --frozen_graph model.pb
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+
+import nlc_model
+
+# Inputs of the exported graph and their types
+_PLACEHOLDERS = {"keep_prob": tf.float32, "source_tokens": tf.int32, "target_tokens": tf.int32,
+                 "source_mask": tf.int32, "target_mask": tf.int32, "beam_size": tf.int32}
+_OUTPUTS = ("encoder_output", "beam_output", "beam_scores", "target_scores", "target_score_lengths")
+
+
+def export(sess, model, path):
+  """Write the frozen inference graph of a restored forward-only model to path."""
+  outputs = [getattr(model, name) for name in _OUTPUTS]
+  # Only the model's global variables are frozen: the local ones hold the
+  # incremental decoding cache, which the exported outputs do not read
+  frozen = graph_util.convert_variables_to_constants(
+    sess, sess.graph.as_graph_def(), [t.op.name for t in outputs],
+    variable_names_whitelist=[v.op.name for v in tf.all_variables()])
+  kept = set(node.name for node in frozen.node)
+
+  # Placeholders the outputs do not depend on were pruned away; they are left
+  # out of the names and the loader gives them stand-ins
+  def name_if_kept(t):
+    return t.name if t.op.name in kept else None
+
+  tensors = dict((name, name_if_kept(getattr(model, name))) for name in list(_PLACEHOLDERS) + list(_OUTPUTS))
+  tensors["decoder_state_input"] = [name_if_kept(t) for t in model.decoder_state_input]
+  with tf.gfile.GFile(path, mode="wb") as f:
+    f.write(frozen.SerializeToString())
+  with tf.gfile.GFile(path + ".json", mode="w") as f:
+    json.dump({"size": model.size, "num_layers": model.num_layers, "vocab_size": model.vocab_size,
+               "tensors": tensors}, f, indent=2)
+  print("Froze %d nodes (of %d) into %s" % (len(frozen.node), len(sess.graph.as_graph_def().node), path))
+
+
+class FrozenNLCModel(nlc_model.NLCModel):
+  """An NLCModel imported from a graph written by export(). encode, decode_beam
+  and score_batch work as in NLCModel; training and incremental decoding do not.
+  The graph is imported into the default graph, which the session must run."""
+
+  def __init__(self, path):
+    with tf.gfile.GFile(path + ".json", mode="r") as f:
+      meta = json.load(f)
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, mode="rb") as f:
+      graph_def.ParseFromString(f.read())
+    tf.import_graph_def(graph_def, name="")
+    graph = tf.get_default_graph()
+
+    self.size = meta["size"]
+    self.num_layers = meta["num_layers"]
+    self.vocab_size = meta["vocab_size"]
+    tensors = meta["tensors"]
+    for name in _OUTPUTS:
+      setattr(self, name, graph.get_tensor_by_name(tensors[name]))
+    # Feeding a stand-in for a pruned placeholder is harmless, so the feeds of
+    # NLCModel work unchanged
+    for name, dtype in _PLACEHOLDERS.items():
+      setattr(self, name, graph.get_tensor_by_name(tensors[name]) if tensors[name] else tf.placeholder(dtype))
+    self.decoder_state_input = [graph.get_tensor_by_name(name) if name else tf.placeholder(tf.float32)
+                                for name in tensors["decoder_state_input"]]
+
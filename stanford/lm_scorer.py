@@ -0,0 +1,79 @@
+# Copyright 2016 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+
+import kenlm
+import numpy as np
+
+
+class LMScorer(object):
+  """Sentence scores of a kenlm model, computed a beam at a time.
+
+  score_all walks the beam's sentences in sorted order with kenlm's stateful
+  BaseScore/State API, so a word prefix shared by several candidates is scored
+  once: the cost of a beam is the size of its prefix trie. Totals are summed in
+  float32 like lm.score does, so the scores are the same. Full-sentence scores
+  are also kept in an LRU cache of up to cache_size sentences, as the same
+  candidates recur across batches and alpha values.
+  """
+
+  def __init__(self, lm, cache_size=100000):
+    self.lm = lm
+    self.cache_size = cache_size
+    self.cache = collections.OrderedDict()
+
+  def score(self, sentence):
+    return self.score_all([sentence])[0]
+
+  def score_all(self, sentences):
+    scores = {}
+    for s in sentences:
+      if s in self.cache:
+        # Re-inserted to mark it as the most recently used
+        scores[s] = self.cache[s] = self.cache.pop(s)
+    missing = sorted(set((tuple(s.split()), s) for s in sentences if s not in scores))
+
+    begin = kenlm.State()
+    self.lm.BeginSentenceWrite(begin)
+    # stack[k] is the state and total after the first k words of the current sentence
+    stack = [(begin, np.float32(0))]
+    previous = ()
+    for words, s in missing:
+      common = 0
+      while common < min(len(words), len(previous)) and words[common] == previous[common]:
+        common += 1
+      del stack[common + 1:]
+      for word in words[common:]:
+        state, total = stack[-1]
+        out = kenlm.State()
+        stack.append((out, total + np.float32(self.lm.BaseScore(state, word, out))))
+      state, total = stack[-1]
+      total += np.float32(self.lm.BaseScore(state, "</s>", kenlm.State()))
+      scores[s] = float(total)
+      self._remember(s, scores[s])
+      previous = words
+    return [scores[s] for s in sentences]
+
+  def _remember(self, sentence, score):
+    if self.cache_size <= 0:
+      return
+    if len(self.cache) >= self.cache_size:
+      self.cache.popitem(last=False)
+    self.cache[sentence] = score
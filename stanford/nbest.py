@@ -0,0 +1,173 @@
+# Copyright 2016 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Binary n-best lists of a decode run, stored as .npy files under a common prefix.
+
+Like the packed corpora of nlc_data, everything is flat arrays indexed by offsets:
+
+  <prefix>.tok.npy     tokens of all candidates, uint16 (uint32 for large vocabularies)
+  <prefix>.cand.npy    int64 offsets of each candidate's tokens, one per candidate plus one
+  <prefix>.score.npy   float32 network score of each candidate
+  <prefix>.tscore.npy  float32 score of each token (optional)
+  <prefix>.src.npy     int64 line number (0-based) of each sentence's source in the decoded input
+  <prefix>.sent.npy    int64 offsets of each sentence's candidates, one per sentence plus one
+
+The sentence offsets are written last, so their presence marks a complete file.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+
+import numpy as np
+from six.moves import xrange
+
+import nlc_data
+
+NBestList = collections.namedtuple("NBestList", ["candidates", "scores", "token_scores", "source_offset"])
+
+_SUFFIXES = ("tok", "cand", "score", "tscore", "src", "sent")
+
+
+def nbest_paths(prefix):
+  return dict((suffix, "%s.%s.npy" % (prefix, suffix)) for suffix in _SUFFIXES)
+
+
+def trim(tokens):
+  """A beam candidate up to the EOS_ID that ends it. The tokens after it pad the candidate to the
+  beam length; PAD_ID tokens before it were generated and are kept. The beam search never extends
+  a hypothesis with EOS_ID, so the first one is the end, and an unused candidate slot, which
+  starts with EOS_ID, comes back empty."""
+  tokens = np.asarray(tokens)
+  ends = np.flatnonzero(tokens == nlc_data.EOS_ID)
+  if len(ends) == 0:
+    return tokens
+  return tokens[:ends[0]]
+
+
+class NBestWriter(object):
+  """Append the n-best lists of a decode run, one sentence at a time. The arrays grow
+  in raw files next to their destination and become .npy files on close()."""
+
+  def __init__(self, prefix, vocab_size, token_scores=False):
+    self.paths = nbest_paths(prefix)
+    self.dtypes = {"tok": np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32,
+                   "cand": np.int64, "score": np.float32, "tscore": np.float32, "src": np.int64}
+    self.suffixes = ["tok", "cand", "score", "src"] + (["tscore"] if token_scores else [])
+    if os.path.exists(self.paths["sent"]):
+      # An earlier run's completion marker must not vouch for the arrays about to be overwritten
+      os.remove(self.paths["sent"])
+    self.files = dict((suffix, open(self.paths[suffix] + ".raw", "wb")) for suffix in self.suffixes)
+    self.sentence_offsets = [0]
+    self.num_tokens = 0
+    self._append("cand", [0])
+
+  def _append(self, suffix, values):
+    np.asarray(values, dtype=self.dtypes[suffix]).tofile(self.files[suffix])
+
+  def write(self, candidates, scores, token_scores=None, source_offset=-1):
+    """Add the n-best list of one sentence: token id sequences, their network scores
+    and, if the writer keeps them, one score per token of each candidate."""
+    if ("tscore" in self.files) != (token_scores is not None):
+      raise ValueError("token_scores must be given exactly when the writer keeps them")
+    ends = []
+    for i, tokens in enumerate(candidates):
+      tokens = np.asarray(tokens)
+      self._append("tok", tokens)
+      if token_scores is not None:
+        if len(token_scores[i]) != len(tokens):
+          raise ValueError("candidate %d has %d tokens but %d token scores" % (i, len(tokens), len(token_scores[i])))
+        self._append("tscore", token_scores[i])
+      self.num_tokens += len(tokens)
+      ends.append(self.num_tokens)
+    self._append("cand", ends)
+    self._append("score", scores)
+    self._append("src", [source_offset])
+    self.sentence_offsets.append(self.sentence_offsets[-1] + len(ends))
+
+  def write_batch(self, beam_toks, beam_probs, source_offsets):
+    """Add the output of decode_beam for a batch, trimming the padding of the candidates."""
+    for toks, probs, source_offset in zip(beam_toks, beam_probs, source_offsets):
+      self.write([trim(t) for t in toks], probs, source_offset=source_offset)
+
+  def close(self):
+    for suffix in self.suffixes:
+      self.files[suffix].close()
+      raw_path = self.paths[suffix] + ".raw"
+      dtype = self.dtypes[suffix]
+      count = os.path.getsize(raw_path) // np.dtype(dtype).itemsize
+      if count == 0:
+        np.save(self.paths[suffix], np.zeros(0, dtype=dtype))
+      else:
+        out = np.lib.format.open_memmap(self.paths[suffix], mode="w+", dtype=dtype, shape=(count,))
+        out[:] = np.memmap(raw_path, dtype=dtype, mode="r")
+        out.flush()
+        del out
+      os.remove(raw_path)
+    if "tscore" not in self.suffixes and os.path.exists(self.paths["tscore"]):
+      # Left by an earlier run that kept token scores
+      os.remove(self.paths["tscore"])
+    # Written last: its presence marks a complete n-best file
+    np.save(self.paths["sent"], np.array(self.sentence_offsets, dtype=np.int64))
+
+  def __enter__(self):
+    return self
+
+  def abort(self):
+    """Close and delete the raw files without writing anything, so an interrupted run
+    does not look complete"""
+    for suffix in self.suffixes:
+      self.files[suffix].close()
+      os.remove(self.paths[suffix] + ".raw")
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+
+class NBestReader(object):
+  """Memory-mapped n-best lists written by NBestWriter; indexing gives an NBestList."""
+
+  def __init__(self, prefix):
+    paths = nbest_paths(prefix)
+    if not os.path.exists(paths["sent"]):
+      raise IOError("No complete n-best lists at %s" % prefix)
+    self.tokens = np.load(paths["tok"], mmap_mode="r")
+    self.candidate_offsets = np.load(paths["cand"], mmap_mode="r")
+    self.scores = np.load(paths["score"], mmap_mode="r")
+    self.source_offsets = np.load(paths["src"], mmap_mode="r")
+    self.sentence_offsets = np.load(paths["sent"], mmap_mode="r")
+    self.token_scores = np.load(paths["tscore"], mmap_mode="r") if os.path.exists(paths["tscore"]) else None
+
+  def __len__(self):
+    return len(self.sentence_offsets) - 1
+
+  def __getitem__(self, i):
+    first, last = self.sentence_offsets[i], self.sentence_offsets[i + 1]
+    offsets = self.candidate_offsets[first:last + 1]
+    candidates = [self.tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    token_scores = None
+    if self.token_scores is not None:
+      token_scores = [self.token_scores[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    return NBestList(candidates, self.scores[first:last], token_scores, int(self.source_offsets[i]))
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self[i]
@@ -20,10 +20,14 @@ from __future__ import print_function
 
 import re
 import gzip
+import multiprocessing
 import os
 import re
+import shutil
 import tarfile
+from collections import Counter
 
+import numpy as np
 from six.moves import urllib
 
 from tensorflow.python.platform import gfile
@@ -83,28 +87,54 @@ def bpe_tokenizer(sentence):
 def remove_nonascii(text):
   return re.sub(r'[^\x00-\x7F]', '', text)
 
+def file_shards(path, num_shards):
+  """Split a file into about num_shards byte ranges. A line belongs to the range its first byte
+  falls in, so the ranges need not be aligned to line boundaries."""
+  size = os.path.getsize(path)
+  step = max(size // max(num_shards, 1), 1)
+  return [(path, start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def shard_lines(path, start, end):
+  with open(path, "rb") as f:
+    pos = start
+    if start > 0:
+      # Skip the tail of the line that began in the previous shard
+      f.seek(start - 1)
+      pos = start - 1 + len(f.readline())
+    while pos < end:
+      line = f.readline()
+      if not line:
+        break
+      pos += len(line)
+      yield line
+
+
+def _count_shard(args):
+  path, start, end, tokenizer, normalize_digits = args
+  counts = Counter()
+  for line in shard_lines(path, start, end):
+    # Remove non-ASCII characters
+    line = remove_nonascii(line)
+    tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
+    if normalize_digits:
+      tokens = [re.sub(_DIGIT_RE, b"0", w) for w in tokens]
+    counts.update(tokens)
+  return counts
+
+
 def create_vocabulary(vocabulary_path, data_paths, max_vocabulary_size,
-                      tokenizer=None, normalize_digits=False):
+                      tokenizer=None, normalize_digits=False, pool=None):
   if not gfile.Exists(vocabulary_path):
     print("Creating vocabulary %s from data %s" % (vocabulary_path, str(data_paths)))
-    vocab = {}
-    for path in data_paths:
-      with gfile.GFile(path, mode="rb") as f:
-        counter = 0
-        for line in f:
-          counter += 1
-          if counter % 100000 == 0:
-            print("  processing line %d" % counter)
-          # Remove non-ASCII characters
-          line = remove_nonascii(line)
-          tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
-          for w in tokens:
-            word = re.sub(_DIGIT_RE, b"0", w) if normalize_digits else w
-            if word in vocab:
-              vocab[word] += 1
-            else:
-              vocab[word] = 1
-    vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
+    num_shards = 4 * multiprocessing.cpu_count() if pool else 1
+    shards = [shard + (tokenizer, normalize_digits)
+              for path in data_paths for shard in file_shards(path, num_shards)]
+    vocab = Counter()
+    for counts in (pool.imap_unordered(_count_shard, shards) if pool else map(_count_shard, shards)):
+      vocab.update(counts)
+    # Ties are broken by the token, so the vocabulary does not depend on the order the shards finish in
+    vocab_list = _START_VOCAB + sorted(vocab, key=lambda w: (-vocab[w], w))
     print("Vocabulary size: %d" % len(vocab_list))
     if len(vocab_list) > max_vocabulary_size:
       vocab_list = vocab_list[:max_vocabulary_size]
@@ -144,49 +174,141 @@ def sentence_to_token_ids(sentence, vocabulary,
   return [vocabulary.get(re.sub(_DIGIT_RE, b"0", w), UNK_ID) for w in words]
 
 
+def _tokenize_shard(args):
+  path, start, end, part_path, vocabulary_path, tokenizer, normalize_digits = args
+  vocab, _ = initialize_vocabulary(vocabulary_path, bpe=(tokenizer==bpe_tokenizer))
+  with open(part_path, "wb") as tokens_file:
+    for line in shard_lines(path, start, end):
+      line = remove_nonascii(line)
+      token_ids = sentence_to_token_ids(line, vocab, tokenizer,
+                                        normalize_digits)
+      tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
+  return part_path
+
+
 def data_to_token_ids(data_path, target_path, vocabulary_path,
-                      tokenizer=None, normalize_digits=False):
+                      tokenizer=None, normalize_digits=False, pool=None):
   if not gfile.Exists(target_path):
     print("Tokenizing data in %s" % data_path)
-    vocab, _ = initialize_vocabulary(vocabulary_path, bpe=(tokenizer==bpe_tokenizer))
-    with gfile.GFile(data_path, mode="rb") as data_file:
-      with gfile.GFile(target_path, mode="w") as tokens_file:
-        counter = 0
-        for line in data_file:
-          counter += 1
-          if counter % 100000 == 0:
-            print("  tokenizing line %d" % counter)
-          line = remove_nonascii(line)
-          token_ids = sentence_to_token_ids(line, vocab, tokenizer,
-                                            normalize_digits)
-          tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
-
-
-
-
-def prepare_nlc_data(data_dir, max_vocabulary_size, tokenizer=char_tokenizer, other_dev_path=None):
+    num_shards = 4 * multiprocessing.cpu_count() if pool else 1
+    shards = [shard + ("%s.part%05d" % (target_path, i), vocabulary_path, tokenizer, normalize_digits)
+              for i, shard in enumerate(file_shards(data_path, num_shards))]
+    # Shards are tokenized in parallel into part files, then joined in input order
+    part_paths = pool.map(_tokenize_shard, shards) if pool else map(_tokenize_shard, shards)
+    with open(target_path + ".tmp", "wb") as tokens_file:
+      for part_path in part_paths:
+        with open(part_path, "rb") as part_file:
+          shutil.copyfileobj(part_file, tokens_file)
+        os.remove(part_path)
+    os.rename(target_path + ".tmp", target_path)
+
+
+
+
+def binary_paths(ids_path):
+  return ids_path + ".tok.npy", ids_path + ".off.npy", ids_path + ".stamp.npy"
+
+
+def _source_stamp(ids_path):
+  stat = os.stat(ids_path)
+  return np.array([stat.st_size, stat.st_mtime], dtype=np.float64)
+
+
+def _packed_is_current(ids_path):
+  """Whether the binary corpus of ids_path is complete and was packed from the token id
+  file as it is now (same size and mtime). Without the text file there is nothing to compare."""
+  if not all(gfile.Exists(path) for path in binary_paths(ids_path)):
+    return False
+  if not gfile.Exists(ids_path):
+    return True
+  return np.array_equal(np.load(binary_paths(ids_path)[2]), _source_stamp(ids_path))
+
+
+def token_ids_to_binary(ids_path, vocabulary_size):
+  """Pack a token id text file into a flat token array (uint16, or uint32 for large vocabularies) and
+  an int64 offsets index with one entry per line plus one, both saved as .npy files. The size and
+  mtime of ids_path are saved with them, and the corpus is packed again once they change."""
+  tokens_path, offsets_path, stamp_path = binary_paths(ids_path)
+  if not _packed_is_current(ids_path):
+    print("Packing token ids in %s" % ids_path)
+    if gfile.Exists(offsets_path):
+      # Removed first, so an interrupted repack does not look complete
+      os.remove(offsets_path)
+    stamp = _source_stamp(ids_path)
+    num_lines, num_tokens = 0, 0
+    with gfile.GFile(ids_path, mode="rb") as ids_file:
+      for line in ids_file:
+        num_lines += 1
+        num_tokens += len(line.split())
+
+    dtype = np.uint16 if vocabulary_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+    offsets = np.zeros(num_lines + 1, dtype=np.int64)
+    if num_tokens == 0:
+      np.save(tokens_path, np.zeros(0, dtype=dtype))
+    else:
+      tokens = np.lib.format.open_memmap(tokens_path, mode="w+", dtype=dtype, shape=(num_tokens,))
+      with gfile.GFile(ids_path, mode="rb") as ids_file:
+        for i, line in enumerate(ids_file):
+          token_ids = [int(s) for s in line.split()]
+          offsets[i + 1] = offsets[i] + len(token_ids)
+          tokens[offsets[i]:offsets[i + 1]] = token_ids
+      tokens.flush()
+      del tokens
+    np.save(stamp_path, stamp)
+    # The offsets are written last, so their presence marks a complete corpus
+    np.save(offsets_path, offsets)
+
+
+def open_token_ids(ids_path):
+  """Memory-map the binary corpus of ids_path, or return None if it has not been packed
+  or is older than the token id file."""
+  tokens_path, offsets_path, _ = binary_paths(ids_path)
+  if not _packed_is_current(ids_path):
+    return None
+  return np.load(tokens_path, mmap_mode="r"), np.load(offsets_path, mmap_mode="r")
+
+
+def prepare_nlc_data(data_dir, max_vocabulary_size, tokenizer=char_tokenizer, other_dev_path=None,
+                     num_workers=None):
   # Get nlc data to the specified directory.
   train_path = '/var/data/train/en'
   dev_path = '/var/data/dev/en'
 
-  # FIXME(zxie) Currently using vocabulary generated by BPE code
-  ## Create vocabularies of the appropriate sizes.
   vocab_path = os.path.join(data_dir, "vocab.dat")
-  if tokenizer != bpe_tokenizer:
-    create_vocabulary(vocab_path, [train_path + ".y.txt", train_path + ".x.txt"],
-                      max_vocabulary_size, tokenizer)
-
-  # Create token ids for the training data.
   y_train_ids_path = train_path + ".ids.y"
   x_train_ids_path = train_path + ".ids.x"
-  data_to_token_ids(train_path + ".y.txt", y_train_ids_path, vocab_path, tokenizer)
-  data_to_token_ids(train_path + ".x.txt", x_train_ids_path, vocab_path, tokenizer)
-
-  # Create token ids for the development data.
   y_dev_ids_path = dev_path + ".ids.y"
   x_dev_ids_path = dev_path + ".ids.x"
-  data_to_token_ids(dev_path + ".y.txt", y_dev_ids_path, vocab_path, tokenizer)
-  data_to_token_ids(dev_path + ".x.txt", x_dev_ids_path, vocab_path, tokenizer)
+
+  # Only start worker processes when there is something left to build
+  pool = None
+  if not all(gfile.Exists(path) for path in
+             (vocab_path, y_train_ids_path, x_train_ids_path, y_dev_ids_path, x_dev_ids_path)):
+    pool = multiprocessing.Pool(num_workers)
+
+  try:
+    # FIXME(zxie) Currently using vocabulary generated by BPE code
+    ## Create vocabularies of the appropriate sizes.
+    if tokenizer != bpe_tokenizer:
+      create_vocabulary(vocab_path, [train_path + ".y.txt", train_path + ".x.txt"],
+                        max_vocabulary_size, tokenizer, pool=pool)
+
+    # Create token ids for the training data.
+    data_to_token_ids(train_path + ".y.txt", y_train_ids_path, vocab_path, tokenizer, pool=pool)
+    data_to_token_ids(train_path + ".x.txt", x_train_ids_path, vocab_path, tokenizer, pool=pool)
+
+    # Create token ids for the development data.
+    data_to_token_ids(dev_path + ".y.txt", y_dev_ids_path, vocab_path, tokenizer, pool=pool)
+    data_to_token_ids(dev_path + ".x.txt", x_dev_ids_path, vocab_path, tokenizer, pool=pool)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  # Pack the token ids into the binary format pair_iter memory-maps.
+  _, rev_vocab = initialize_vocabulary(vocab_path)
+  for ids_path in (y_train_ids_path, x_train_ids_path, y_dev_ids_path, x_dev_ids_path):
+    token_ids_to_binary(ids_path, len(rev_vocab))
 
   return (x_train_ids_path, y_train_ids_path,
           x_dev_ids_path, y_dev_ids_path, vocab_path)
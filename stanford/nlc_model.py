@@ -18,6 +18,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
 import random
 
 import numpy as np
@@ -45,9 +46,15 @@ def get_optimizer(opt):
     assert(False)
   return optfn
 
+def gather_batch(inp, indices):
+  # Gather columns of a time-major [T, batch, ...] tensor
+  perm = [1, 0] + list(xrange(2, inp.get_shape().ndims))
+  return tf.transpose(tf.gather(tf.transpose(inp, perm=perm), indices), perm=perm)
+
 class GRUCellAttn(rnn_cell.GRUCell):
-  def __init__(self, num_units, encoder_output, scope=None):
+  def __init__(self, num_units, encoder_output, mask=None, scope=None):
     self.hs = encoder_output
+    self.mask = mask
     with vs.variable_scope(scope or type(self).__name__):
       with vs.variable_scope("Attn1"):
         hs2d = tf.reshape(self.hs, [-1, num_units])
@@ -55,12 +62,22 @@ class GRUCellAttn(rnn_cell.GRUCell):
         self.phi_hs = tf.reshape(phi_hs2d, tf.shape(self.hs))
     super(GRUCellAttn, self).__init__(num_units)
 
+  def attend_to(self, hs, phi_hs, mask=None):
+    """Copy of this cell attending over hs (keys phi_hs), optionally masking padded source positions."""
+    cell = copy.copy(self)
+    cell.hs, cell.phi_hs, cell.mask = hs, phi_hs, mask
+    return cell
+
   def __call__(self, inputs, state, scope=None):
     gru_out, gru_state = super(GRUCellAttn, self).__call__(inputs, state, scope)
     with vs.variable_scope(scope or type(self).__name__):
       with vs.variable_scope("Attn2"):
         gamma_h = tanh(rnn_cell._linear(gru_out, self._num_units, True, 1.0))
       weights = tf.reduce_sum(self.phi_hs * gamma_h, reduction_indices=2, keep_dims=True)
+      if self.mask is not None:
+        # Padded positions get a large negative logit before the max, so they neither take
+        # attention nor shift the max the real positions are normalized by
+        weights += tf.expand_dims(1e9 * (tf.to_float(self.mask) - 1.0), 2)
       weights = tf.exp(weights - tf.reduce_max(weights, reduction_indices=0, keep_dims=True))
       weights = weights / (1e-6 + tf.reduce_sum(weights, reduction_indices=0, keep_dims=True))
       context = tf.reduce_sum(self.hs * weights, reduction_indices=0)
@@ -99,8 +116,10 @@ class NLCModel(object):
       self.setup_encoder()
       self.setup_decoder()
       self.setup_loss()
+      self.setup_scoring()
 
       self.setup_beam()
+      self.setup_step()
 
     params = tf.trainable_variables()
     if not forward_only:
@@ -136,13 +155,18 @@ class NLCModel(object):
           dropin, mask = self.downscale(out, mask)
           inp = self.dropout(dropin)
       self.encoder_output = out
+      self.encoder_mask = mask
 
   def setup_decoder(self):
     if self.num_layers > 1:
       self.decoder_cell = rnn_cell.GRUCell(self.size)
-    self.attn_cell = GRUCellAttn(self.size, self.encoder_output, scope="DecoderAttnCell")
+    self.attn_cell = GRUCellAttn(self.size, self.encoder_output, self.encoder_mask, scope="DecoderAttnCell")
+    self.decoder_output, self.decoder_state_output = self.decoder_rnn(self.attn_cell)
 
-    with vs.variable_scope("Decoder"):
+  def decoder_rnn(self, attn_cell, reuse=None):
+    decoder_output, decoder_state_output = None, []
+
+    with vs.variable_scope("Decoder", reuse=reuse):
       inp = self.decoder_inputs
       for i in xrange(self.num_layers - 1):
         with vs.variable_scope("DecoderCell%d" % i) as scope:
@@ -150,18 +174,21 @@ class NLCModel(object):
                                               dtype=dtypes.float32, sequence_length=self.target_length,
                                               scope=scope, initial_state=self.decoder_state_input[i])
           inp = self.dropout(out)
-          self.decoder_state_output.append(state_output)
+          decoder_state_output.append(state_output)
 
       with vs.variable_scope("DecoderAttnCell") as scope:
-        out, state_output = rnn.dynamic_rnn(self.attn_cell, inp, time_major=True,
+        out, state_output = rnn.dynamic_rnn(attn_cell, inp, time_major=True,
                                             dtype=dtypes.float32, sequence_length=self.target_length,
-                                            scope=scope, initial_state=self.decoder_state_input[i+1])
-        self.decoder_output = self.dropout(out)
-        self.decoder_state_output.append(state_output)
+                                            scope=scope, initial_state=self.decoder_state_input[-1])
+        decoder_output = self.dropout(out)
+        decoder_state_output.append(state_output)
+
+    return decoder_output, decoder_state_output
 
-  def decoder_graph(self, decoder_inputs, decoder_state_input):
+  def decoder_graph(self, decoder_inputs, decoder_state_input, attn_cell=None):
     decoder_output, decoder_state_output = None, []
     inp = decoder_inputs
+    attn_cell = attn_cell or self.attn_cell
 
     with vs.variable_scope("Decoder", reuse=True):
       for i in xrange(self.num_layers - 1):
@@ -170,71 +197,92 @@ class NLCModel(object):
           decoder_state_output.append(state_output)
 
       with vs.variable_scope("DecoderAttnCell") as scope:
-        decoder_output, state_output = self.attn_cell(inp, decoder_state_input[i+1])
+        decoder_output, state_output = attn_cell(inp, decoder_state_input[i+1])
         decoder_state_output.append(state_output)
 
     return decoder_output, decoder_state_output
 
   def setup_beam(self):
+    # Beam search over every sentence of the encoder batch at once. Hypotheses are laid out
+    # sentence-major, beam_size per sentence, and each sentence keeps its own candidate list.
+    batch_size = tf.shape(self.encoder_output)[1]
+    beam_size = self.beam_size
+    beam_offsets = tf.reshape(tf.range(batch_size) * beam_size, [-1, 1])
+    beam_index = tf.reshape(tf.tile(tf.reshape(tf.range(batch_size), [-1, 1]), tf.pack([1, beam_size])), [-1])
+    beam_cell = self.attn_cell.attend_to(gather_batch(self.attn_cell.hs, beam_index),
+                                         gather_batch(self.attn_cell.phi_hs, beam_index),
+                                         gather_batch(self.encoder_mask, beam_index))
+
     time_0 = tf.constant(0)
-    beam_seqs_0 = tf.constant([[nlc_data.SOS_ID]])
-    beam_probs_0 = tf.constant([0.])
+    beam_seqs_0 = tf.fill(tf.pack([batch_size, beam_size, 1]), nlc_data.SOS_ID)
+    beam_probs_0 = tf.concat(1, [tf.zeros(tf.pack([batch_size, 1])),
+                                 tf.fill(tf.pack([batch_size, beam_size - 1]), -3e38)])
 
-    cand_seqs_0 = tf.constant([[nlc_data.EOS_ID]])
-    cand_probs_0 = tf.constant([-3e38])
+    cand_seqs_0 = tf.fill(tf.pack([batch_size, beam_size, 1]), nlc_data.EOS_ID)
+    cand_probs_0 = tf.fill(tf.pack([batch_size, beam_size]), -3e38)
 
-    state_0 = tf.zeros([1, self.size])
+    state_0 = tf.zeros(tf.pack([batch_size * beam_size, self.size]))
     states_0 = [state_0] * self.num_layers
 
+    def beam_active(beam_probs, cand_probs):
+      return tf.reduce_max(beam_probs, reduction_indices=1) >= tf.reduce_min(cand_probs, reduction_indices=1)
+
     def beam_cond(time, beam_probs, beam_seqs, cand_probs, cand_seqs, *states):
-      return tf.reduce_max(beam_probs) >= tf.reduce_min(cand_probs)
+      return tf.reduce_any(beam_active(beam_probs, cand_probs))
 
     def beam_step(time, beam_probs, beam_seqs, cand_probs, cand_seqs, *states):
-      batch_size = tf.shape(beam_probs)[0]
-      inputs = tf.reshape(tf.slice(beam_seqs, [0, time], [batch_size, 1]), [batch_size])
+      inputs = tf.reshape(tf.slice(beam_seqs, [0, 0, time], [-1, -1, 1]), [-1])
       decoder_input = embedding_ops.embedding_lookup(self.L_dec, inputs)
-      decoder_output, state_output = self.decoder_graph(decoder_input, states)
+      decoder_output, state_output = self.decoder_graph(decoder_input, states, attn_cell=beam_cell)
 
       with vs.variable_scope("Logistic", reuse=True):
         do2d = tf.reshape(decoder_output, [-1, self.size])
         logits2d = rnn_cell._linear(do2d, self.vocab_size, True, 1.0)
         logprobs2d = tf.nn.log_softmax(logits2d)
 
-      total_probs = logprobs2d + tf.reshape(beam_probs, [-1, 1])
-      total_probs_noEOS = tf.concat(1, [tf.slice(total_probs, [0, 0], [batch_size, nlc_data.EOS_ID]),
-                                        tf.tile([[-3e38]], [batch_size, 1]),
-                                        tf.slice(total_probs, [0, nlc_data.EOS_ID + 1],
-                                                 [batch_size, self.vocab_size - nlc_data.EOS_ID - 1])])
+      total_probs = tf.reshape(logprobs2d + tf.reshape(beam_probs, [-1, 1]),
+                               tf.pack([batch_size, beam_size, self.vocab_size]))
+      # Finished sentences neither extend their beams nor add candidates
+      total_probs = tf.select(beam_active(beam_probs, cand_probs), total_probs,
+                              tf.fill(tf.shape(total_probs), -3e38))
+      total_probs_noEOS = tf.concat(2, [tf.slice(total_probs, [0, 0, 0], [-1, -1, nlc_data.EOS_ID]),
+                                        tf.fill(tf.pack([batch_size, beam_size, 1]), -3e38),
+                                        tf.slice(total_probs, [0, 0, nlc_data.EOS_ID + 1], [-1, -1, -1])])
 
-      flat_total_probs = tf.reshape(total_probs_noEOS, [-1])
-      beam_k = tf.minimum(tf.size(flat_total_probs), self.beam_size)
-      next_beam_probs, top_indices = tf.nn.top_k(flat_total_probs, k=beam_k)
+      flat_total_probs = tf.reshape(total_probs_noEOS, tf.pack([batch_size, -1]))
+      next_beam_probs, top_indices = tf.nn.top_k(flat_total_probs, k=beam_size)
 
-      next_bases = tf.floordiv(top_indices, self.vocab_size)
+      next_bases = tf.reshape(tf.floordiv(top_indices, self.vocab_size) + beam_offsets, [-1])
       next_mods = tf.mod(top_indices, self.vocab_size)
 
       next_states = [tf.gather(state, next_bases) for state in state_output]
-      next_beam_seqs = tf.concat(1, [tf.gather(beam_seqs, next_bases),
-                                     tf.reshape(next_mods, [-1, 1])])
-
-      cand_seqs_pad = tf.pad(cand_seqs, [[0, 0], [0, 1]])
-      beam_seqs_EOS = tf.pad(beam_seqs, [[0, 0], [0, 1]])
-      new_cand_seqs = tf.concat(0, [cand_seqs_pad, beam_seqs_EOS])
-      EOS_probs = tf.slice(total_probs, [0, nlc_data.EOS_ID], [batch_size, 1])
-      new_cand_probs = tf.concat(0, [cand_probs, tf.reshape(EOS_probs, [-1])])
-
-      cand_k = tf.minimum(tf.size(new_cand_probs), self.beam_size)
-      next_cand_probs, next_cand_indices = tf.nn.top_k(new_cand_probs, k=cand_k)
-      next_cand_seqs = tf.gather(new_cand_seqs, next_cand_indices)
+      flat_beam_seqs = tf.reshape(beam_seqs, tf.pack([batch_size * beam_size, -1]))
+      next_beam_seqs = tf.concat(2, [tf.reshape(tf.gather(flat_beam_seqs, next_bases),
+                                                tf.pack([batch_size, beam_size, -1])),
+                                     tf.expand_dims(next_mods, 2)])
+
+      cand_seqs_pad = tf.pad(cand_seqs, [[0, 0], [0, 0], [0, 1]])
+      # A candidate ends in an explicit EOS_ID: PAD_ID may be generated, so only EOS_ID tells its
+      # tokens from the padding that cand_seqs_pad adds
+      beam_seqs_EOS = tf.concat(2, [beam_seqs, tf.fill(tf.pack([batch_size, beam_size, 1]), nlc_data.EOS_ID)])
+      new_cand_seqs = tf.concat(1, [cand_seqs_pad, beam_seqs_EOS])
+      EOS_probs = tf.slice(total_probs, [0, 0, nlc_data.EOS_ID], [-1, -1, 1])
+      new_cand_probs = tf.concat(1, [cand_probs, tf.squeeze(EOS_probs, [2])])
+
+      next_cand_probs, next_cand_indices = tf.nn.top_k(new_cand_probs, k=beam_size)
+      next_cand_indices = tf.reshape(next_cand_indices + 2 * beam_offsets, [-1])
+      flat_cand_seqs = tf.reshape(new_cand_seqs, tf.pack([2 * batch_size * beam_size, -1]))
+      next_cand_seqs = tf.reshape(tf.gather(flat_cand_seqs, next_cand_indices),
+                                  tf.pack([batch_size, beam_size, -1]))
 
       return [time + 1, next_beam_probs, next_beam_seqs, next_cand_probs, next_cand_seqs] + next_states
 
     var_shape = []
     var_shape.append((time_0, time_0.get_shape()))
-    var_shape.append((beam_probs_0, tf.TensorShape([None,])))
-    var_shape.append((beam_seqs_0, tf.TensorShape([None, None])))
-    var_shape.append((cand_probs_0, tf.TensorShape([None,])))
-    var_shape.append((cand_seqs_0, tf.TensorShape([None, None])))
+    var_shape.append((beam_probs_0, tf.TensorShape([None, None])))
+    var_shape.append((beam_seqs_0, tf.TensorShape([None, None, None])))
+    var_shape.append((cand_probs_0, tf.TensorShape([None, None])))
+    var_shape.append((cand_seqs_0, tf.TensorShape([None, None, None])))
     var_shape.extend([(state_0, tf.TensorShape([None, self.size])) for state_0 in states_0])
     loop_vars, loop_var_shapes = zip(* var_shape)
     ret_vars = tf.while_loop(cond=beam_cond, body=beam_step, loop_vars=loop_vars, shape_invariants=loop_var_shapes, back_prop=False)
@@ -244,23 +292,67 @@ class NLCModel(object):
     self.beam_output = cand_seqs
     self.beam_scores = cand_probs
 
+  def setup_step(self):
+    # Incremental decoding: prime_step keeps a batch's encoder output and attention keys resident in
+    # the session, and decode_step advances any set of hypotheses over that batch by one token.
+    def resident(value, ndims):
+      var = tf.Variable(tf.zeros([0] * ndims, dtype=value.dtype), trainable=False, validate_shape=False,
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+      read = tf.identity(var)
+      read.set_shape(value.get_shape())
+      return var, read
+
+    hs_var, hs = resident(self.attn_cell.hs, 3)
+    phi_hs_var, phi_hs = resident(self.attn_cell.phi_hs, 3)
+    mask_var, mask = resident(self.encoder_mask, 2)
+    self.step_cache_op = tf.group(tf.assign(hs_var, self.attn_cell.hs, validate_shape=False),
+                                  tf.assign(phi_hs_var, self.attn_cell.phi_hs, validate_shape=False),
+                                  tf.assign(mask_var, self.encoder_mask, validate_shape=False))
+
+    self.step_index = tf.placeholder(tf.int32, shape=[None])
+    self.step_tokens = tf.placeholder(tf.int32, shape=[None])
+    step_cell = self.attn_cell.attend_to(gather_batch(hs, self.step_index),
+                                         gather_batch(phi_hs, self.step_index),
+                                         gather_batch(mask, self.step_index))
+
+    decoder_input = embedding_ops.embedding_lookup(self.L_dec, self.step_tokens)
+    decoder_output, self.step_state_output = self.decoder_graph(decoder_input, self.decoder_state_input,
+                                                                attn_cell=step_cell)
+    with vs.variable_scope("Logistic", reuse=True):
+      logits2d = rnn_cell._linear(decoder_output, self.vocab_size, True, 1.0)
+      self.step_logprobs = tf.nn.log_softmax(logits2d)
+
   def setup_loss(self):
     with vs.variable_scope("Logistic"):
-      doshape = tf.shape(self.decoder_output)
-      T, batch_size = doshape[0], doshape[1]
-      do2d = tf.reshape(self.decoder_output, [-1, self.size])
-      logits2d = rnn_cell._linear(do2d, self.vocab_size, True, 1.0)
-      outputs2d = tf.nn.log_softmax(logits2d)
-      self.outputs = tf.reshape(outputs2d, tf.pack([T, batch_size, self.vocab_size]))
-
-      targets_no_GO = tf.slice(self.target_tokens, [1, 0], [-1, -1])
-      masks_no_GO = tf.slice(self.target_mask, [1, 0], [-1, -1])
-      # easier to pad target/mask than to split decoder input since tensorflow does not support negative indexing
-      labels1d = tf.reshape(tf.pad(targets_no_GO, [[0, 1], [0, 0]]), [-1])
-      mask1d = tf.reshape(tf.pad(masks_no_GO, [[0, 1], [0, 0]]), [-1])
-      losses1d = tf.nn.sparse_softmax_cross_entropy_with_logits(logits2d, labels1d) * tf.to_float(mask1d)
-      losses2d = tf.reshape(losses1d, tf.pack([T, batch_size]))
-      self.losses = tf.reduce_sum(losses2d) / tf.to_float(batch_size)
+      self.outputs, losses2d = self.logistic(self.decoder_output)
+      self.losses = tf.reduce_sum(losses2d) / tf.to_float(tf.shape(losses2d)[1])
+
+  def setup_scoring(self):
+    # Teacher-forced log-probabilities of whole target sentences. Padded source positions are masked
+    # out of attention, as in training and beam search, so a sentence scores the same whatever batch it is in.
+    decoder_output, _ = self.decoder_rnn(self.attn_cell, reuse=True)
+    with vs.variable_scope("Logistic", reuse=True):
+      _, losses2d = self.logistic(decoder_output)
+    self.target_scores = -tf.reduce_sum(losses2d, reduction_indices=0)
+    self.target_score_lengths = tf.to_float(tf.reduce_sum(tf.slice(self.target_mask, [1, 0], [-1, -1]),
+                                                          reduction_indices=0))
+
+  def logistic(self, decoder_output):
+    doshape = tf.shape(decoder_output)
+    T, batch_size = doshape[0], doshape[1]
+    do2d = tf.reshape(decoder_output, [-1, self.size])
+    logits2d = rnn_cell._linear(do2d, self.vocab_size, True, 1.0)
+    outputs2d = tf.nn.log_softmax(logits2d)
+    outputs = tf.reshape(outputs2d, tf.pack([T, batch_size, self.vocab_size]))
+
+    targets_no_GO = tf.slice(self.target_tokens, [1, 0], [-1, -1])
+    masks_no_GO = tf.slice(self.target_mask, [1, 0], [-1, -1])
+    # easier to pad target/mask than to split decoder input since tensorflow does not support negative indexing
+    labels1d = tf.reshape(tf.pad(targets_no_GO, [[0, 1], [0, 0]]), [-1])
+    mask1d = tf.reshape(tf.pad(masks_no_GO, [[0, 1], [0, 0]]), [-1])
+    losses1d = tf.nn.sparse_softmax_cross_entropy_with_logits(logits2d, labels1d) * tf.to_float(mask1d)
+    losses2d = tf.reshape(losses1d, tf.pack([T, batch_size]))
+    return outputs, losses2d
 
   def dropout(self, inp):
     return tf.nn.dropout(inp, self.keep_prob)
@@ -341,6 +433,22 @@ class NLCModel(object):
 
     return outputs[0]
 
+  def score_batch(self, session, source_tokens, source_mask, target_tokens, target_mask):
+    input_feed = {}
+    input_feed[self.source_tokens] = source_tokens
+    input_feed[self.target_tokens] = target_tokens
+    input_feed[self.source_mask] = source_mask
+    input_feed[self.target_mask] = target_mask
+    input_feed[self.keep_prob] = 1.
+    self.set_default_decoder_state_input(input_feed, target_tokens.shape[1])
+
+    output_feed = [self.target_scores, self.target_score_lengths]
+
+    scores, lengths = session.run(output_feed, input_feed)
+
+    # Summed and length-normalized log-probability of each target sentence
+    return scores, scores / lengths
+
   def encode(self, session, source_tokens, source_mask):
     input_feed = {}
     input_feed[self.source_tokens] = source_tokens
@@ -372,9 +480,36 @@ class NLCModel(object):
 
     return outputs[0], None, outputs[1:]
 
-  def decode_beam(self, session, encoder_output, beam_size=8):
+  def prime_step(self, session, encoder_output, source_mask=None):
+    input_feed = {}
+    input_feed[self.encoder_output] = encoder_output
+    input_feed[self.source_mask] = source_mask if source_mask is not None else np.ones(encoder_output.shape[:2])
+    input_feed[self.keep_prob] = 1.
+
+    session.run(self.step_cache_op, input_feed)
+
+  def decode_step(self, session, step_index, tokens, decoder_states=None):
+    # step_index[n] is the sentence (column of the primed encoder output) that hypothesis n decodes
+    input_feed = {}
+    input_feed[self.step_index] = step_index
+    input_feed[self.step_tokens] = tokens
+
+    if not decoder_states:
+      self.set_default_decoder_state_input(input_feed, len(tokens))
+    else:
+      for i in xrange(self.num_layers):
+        input_feed[self.decoder_state_input[i]] = decoder_states[i]
+
+    output_feed = [self.step_logprobs] + self.step_state_output
+
+    outputs = session.run(output_feed, input_feed)
+
+    return outputs[0], outputs[1:]
+
+  def decode_beam(self, session, encoder_output, beam_size=8, source_mask=None):
     input_feed = {}
     input_feed[self.encoder_output] = encoder_output
+    input_feed[self.source_mask] = source_mask if source_mask is not None else np.ones(encoder_output.shape[:2])
     input_feed[self.keep_prob] = 1.
     input_feed[self.beam_size] = beam_size
 
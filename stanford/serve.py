@@ -0,0 +1,259 @@
+# Copyright 2016 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Long-running correction service around decode.fix_sents.
+
+The checkpoint and language model are loaded once. Concurrent requests are
+coalesced into micro-batches before they reach the encoder and beam search.
+
+  POST /correct  {"sentences": ["...", ...]}  ->  {"corrections": ["...", ...]}
+  GET  /stats    latency and throughput counters
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import six
+from six.moves import BaseHTTPServer
+from six.moves import queue
+from six.moves import socketserver
+from six.moves import xrange
+import tensorflow as tf
+
+import decode
+
+tf.app.flags.DEFINE_string("host", "127.0.0.1", "Address to listen on.")
+tf.app.flags.DEFINE_integer("port", 8000, "Port to listen on.")
+tf.app.flags.DEFINE_string("socket", None, "Listen on this Unix socket instead of host:port.")
+tf.app.flags.DEFINE_integer("max_batch_sentences", 64, "Most sentences decoded in one micro-batch.")
+tf.app.flags.DEFINE_float("max_wait_ms", 10.0, "Longest a request waits for others to join its micro-batch.")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class Request(object):
+  def __init__(self, sents):
+    self.sents = sents
+    self.corrections = None
+    self.error = None
+    self.arrival = time.time()
+    self.done = threading.Event()
+
+
+class Stats(object):
+  """Counters shared by the handler threads and the batcher."""
+
+  def __init__(self, window=1000):
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+    self.requests = 0
+    self.sentences = 0
+    self.batches = 0
+    self.errors = 0
+    self.decode_time = 0.
+    self.latencies = collections.deque(maxlen=window)
+
+  def record_batch(self, requests, num_sents, decode_time):
+    now = time.time()
+    with self.lock:
+      self.batches += 1
+      self.requests += len(requests)
+      self.sentences += num_sents
+      self.decode_time += decode_time
+      self.latencies.extend(now - request.arrival for request in requests)
+
+  def record_error(self):
+    with self.lock:
+      self.errors += 1
+
+  def snapshot(self):
+    with self.lock:
+      uptime = time.time() - self.start_time
+      latencies = np.array(self.latencies) * 1000.
+      out = {
+        "uptime_s": uptime,
+        "requests": self.requests,
+        "sentences": self.sentences,
+        "batches": self.batches,
+        "errors": self.errors,
+        "mean_batch_sentences": self.sentences / max(self.batches, 1),
+        "sentences_per_s": self.sentences / max(uptime, 1e-6),
+        "decode_sentences_per_s": self.sentences / max(self.decode_time, 1e-6),
+      }
+      if len(latencies):
+        out["latency_ms"] = {
+          "mean": float(np.mean(latencies)),
+          "p50": float(np.percentile(latencies, 50)),
+          "p95": float(np.percentile(latencies, 95)),
+          "max": float(np.max(latencies)),
+        }
+      return out
+
+
+class Batcher(threading.Thread):
+  """Owns the session: drains queued requests into micro-batches and decodes them."""
+
+  def __init__(self, model, sess, stats, max_sents, max_wait):
+    super(Batcher, self).__init__()
+    self.daemon = True
+    self.model = model
+    self.sess = sess
+    self.stats = stats
+    self.max_sents = max_sents
+    self.max_wait = max_wait
+    self.requests = queue.Queue()
+    self.pending = None
+
+  def submit(self, sents):
+    request = Request(sents)
+    self.requests.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.corrections
+
+  def next_batch(self):
+    # Block for the first request, then take whatever else arrives until the batch is full or the
+    # first request has waited max_wait. A request never gets split across batches.
+    batch = [self.pending or self.requests.get()]
+    self.pending = None
+    num_sents = len(batch[0].sents)
+    deadline = batch[0].arrival + self.max_wait
+    while num_sents < self.max_sents:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        request = self.requests.get(timeout=timeout)
+      except queue.Empty:
+        break
+      if num_sents + len(request.sents) > self.max_sents:
+        self.pending = request
+        break
+      batch.append(request)
+      num_sents += len(request.sents)
+    return batch, num_sents
+
+  def run(self):
+    while True:
+      batch, num_sents = self.next_batch()
+      sents = [sent for request in batch for sent in request.sents]
+      tic = time.time()
+      try:
+        corrections = []
+        for start in xrange(0, len(sents), self.max_sents):
+          corrections.extend(decode.fix_sents(self.model, self.sess, sents[start:start + self.max_sents]))
+      except Exception as e:
+        for request in batch:
+          request.error = e
+          request.done.set()
+        self.stats.record_error()
+        continue
+      toc = time.time()
+
+      offset = 0
+      for request in batch:
+        request.corrections = corrections[offset:offset + len(request.sents)]
+        offset += len(request.sents)
+        request.done.set()
+      self.stats.record_batch(batch, num_sents, toc - tic)
+
+
+class CorrectionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def send_json(self, code, obj):
+    body = json.dumps(obj)
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path == "/stats":
+      self.send_json(200, self.server.stats.snapshot())
+    else:
+      self.send_json(404, {"error": "not found"})
+
+  def do_POST(self):
+    if self.path != "/correct":
+      self.send_json(404, {"error": "not found"})
+      return
+    try:
+      length = int(self.headers.get("Content-Length", 0))
+      payload = json.loads(self.rfile.read(length))
+      sents = payload["sentences"] if "sentences" in payload else [payload["sentence"]]
+      sents = [s.encode("utf-8") if isinstance(s, six.text_type) else s for s in sents]
+    except (ValueError, KeyError, TypeError) as e:
+      self.send_json(400, {"error": "bad request: %s" % e})
+      return
+    if not sents:
+      self.send_json(200, {"corrections": []})
+      return
+    try:
+      corrections = self.server.batcher.submit(sents)
+    except Exception as e:
+      self.send_json(500, {"error": str(e)})
+      return
+    self.send_json(200, {"corrections": corrections})
+
+  def address_string(self):
+    # Unix socket peers have no host to report
+    return self.client_address[0] if self.client_address else FLAGS.socket
+
+  def log_message(self, format, *args):
+    pass
+
+
+class TCPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def serve():
+  with tf.Session() as sess:
+    model = decode.load(sess)
+
+    stats = Stats()
+    batcher = Batcher(model, sess, stats, FLAGS.max_batch_sentences, FLAGS.max_wait_ms / 1000.)
+    batcher.start()
+
+    if FLAGS.socket:
+      if os.path.exists(FLAGS.socket):
+        os.remove(FLAGS.socket)
+      server = UnixServer(FLAGS.socket, CorrectionHandler)
+      print("Serving corrections on %s" % FLAGS.socket)
+    else:
+      server = TCPServer((FLAGS.host, FLAGS.port), CorrectionHandler)
+      print("Serving corrections on %s:%d" % (FLAGS.host, FLAGS.port))
+    server.batcher = batcher
+    server.stats = stats
+    server.serve_forever()
+
+def main(_):
+  serve()
+
+if __name__ == "__main__":
+  tf.app.run()
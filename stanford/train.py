@@ -34,6 +34,8 @@ import nlc_data
 
 from util import pair_iter
 from util import get_tokenizer
+from util import get_buckets
+from util import Prefetcher
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -54,6 +56,9 @@ tf.app.flags.DEFINE_string("train_dir", "/tmp", "Training directory.")
 tf.app.flags.DEFINE_string("tokenizer", "CHAR", "BPE / CHAR / WORD.")
 tf.app.flags.DEFINE_string("optimizer", "adam", "adam / sgd")
 tf.app.flags.DEFINE_integer("print_every", 1, "How many iterations to do per print.")
+tf.app.flags.DEFINE_string("buckets", "", "Comma-separated length boundaries for bucketed batching, e.g. 10,20,40,80.")
+tf.app.flags.DEFINE_integer("max_tokens", 0, "Padded tokens per batch; 0 uses a fixed batch_size.")
+tf.app.flags.DEFINE_integer("prefetch", 8, "Training batches prepared ahead in a background thread; 0 disables.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -75,7 +80,9 @@ def create_model(session, vocab_size, forward_only):
 
 def validate(model, sess, x_dev, y_dev):
   valid_costs, valid_lengths = [], []
-  for source_tokens, source_mask, target_tokens, target_mask in pair_iter(x_dev, y_dev, FLAGS.batch_size, FLAGS.num_layers):
+  for source_tokens, source_mask, target_tokens, target_mask in pair_iter(x_dev, y_dev, FLAGS.batch_size, FLAGS.num_layers,
+                                                                          buckets=get_buckets(FLAGS),
+                                                                          max_tokens=FLAGS.max_tokens):
     cost = model.test(sess, source_tokens, source_mask, target_tokens, target_mask)
     valid_costs.append(cost * target_mask.shape[1])
     valid_lengths.append(np.sum(target_mask[1:, :]))
@@ -131,7 +138,10 @@ def train():
 
       ## Train
       epoch_tic = time.time()
-      for source_tokens, source_mask, target_tokens, target_mask in pair_iter(x_train, y_train, FLAGS.batch_size, FLAGS.num_layers):
+      batches = Prefetcher(pair_iter(x_train, y_train, FLAGS.batch_size, FLAGS.num_layers,
+                                     buckets=get_buckets(FLAGS), max_tokens=FLAGS.max_tokens),
+                           FLAGS.prefetch)
+      for source_tokens, source_mask, target_tokens, target_mask in batches:
         # Get a batch and make a step.
         tic = time.time()
 
@@ -169,7 +179,9 @@ def train():
       ## Validate
       valid_cost = validate(model, sess, x_dev, y_dev)
 
-      logging.info("Epoch %d Validation cost: %f time: %f" % (epoch, valid_cost, epoch_toc - epoch_tic))
+      logging.info("Epoch %d Validation cost: %f time: %f input wait: %f (%.1f%%)" %
+                   (epoch, valid_cost, epoch_toc - epoch_tic, batches.wait_time,
+                    100. * batches.wait_time / max(epoch_toc - epoch_tic, 1e-6)))
 
       if len(previous_losses) > 2 and valid_cost > previous_losses[-1]:
         logging.info("Annealing learning rate by %f" % FLAGS.learning_rate_decay_factor)
@@ -17,9 +17,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
+import itertools
+import sys
+import threading
+import time
+
 import nlc_data
 import numpy as np
+import six
+from six.moves import queue
 from six.moves import xrange
+from six.moves import zip as izip
 import tensorflow as tf
 import random
 
@@ -29,17 +38,41 @@ FLAGS = tf.app.flags.FLAGS
 def tokenize(string):
   return [int(s) for s in string.split()]
 
-def pair_iter(fnamex, fnamey, batch_size, num_layers, sort_and_shuffle=True):
-  fdx, fdy = open(fnamex), open(fnamey)
-  batches = []
+def token_lines(fname, chunk_lines=4096):
+  # Token id lists, one per line: sliced out of the binary corpus when it has been packed,
+  # parsed from the text file otherwise.
+  corpus = nlc_data.open_token_ids(fname)
+  if corpus is None:
+    for line in open(fname):
+      yield tokenize(line)
+    return
+
+  tokens, offsets = corpus
+  num_lines = len(offsets) - 1
+  for start in xrange(0, num_lines, chunk_lines):
+    end = min(start + chunk_lines, num_lines)
+    base = offsets[start]
+    block = tokens[base:offsets[end]].tolist()
+    bounds = (offsets[start:end + 1] - base).tolist()
+    for i in xrange(end - start):
+      yield block[bounds[i]:bounds[i + 1]]
+
+def pair_iter(fnamex, fnamey, batch_size, num_layers, sort_and_shuffle=True, buckets=None, max_tokens=None,
+              line_numbers=False):
+  # With line_numbers, each batch also carries the 0-based input line of every pair, as pairs of
+  # max_seq_len tokens or more are dropped and batch positions no longer follow the input
+  if line_numbers:
+    pairs = izip(token_lines(fnamex), token_lines(fnamey), itertools.count())
+  else:
+    pairs = izip(token_lines(fnamex), token_lines(fnamey))
 
-  while True:
-    if len(batches) == 0:
-      refill(batches, fdx, fdy, batch_size, sort_and_shuffle=sort_and_shuffle)
-    if len(batches) == 0:
-      break
+  if buckets or max_tokens:
+    batch_iter = bucket_batches(pairs, batch_size, buckets, max_tokens, num_layers, shuffle=sort_and_shuffle)
+  else:
+    batch_iter = window_batches(pairs, batch_size, sort_and_shuffle=sort_and_shuffle)
 
-    x_tokens, y_tokens = batches.pop(0)
+  for batch in batch_iter:
+    x_tokens, y_tokens = batch[:2]
     y_tokens = add_sos_eos(y_tokens)
     x_padded, y_padded = padded(x_tokens, num_layers), padded(y_tokens, 1)
 
@@ -48,43 +81,152 @@ def pair_iter(fnamex, fnamey, batch_size, num_layers, sort_and_shuffle=True):
     target_tokens = np.array(y_padded).T
     target_mask = (target_tokens != nlc_data.PAD_ID).astype(np.int32)
 
-    yield (source_tokens, source_mask, target_tokens, target_mask)
+    if line_numbers:
+      yield (source_tokens, source_mask, target_tokens, target_mask, list(batch[2]))
+    else:
+      yield (source_tokens, source_mask, target_tokens, target_mask)
 
   return
 
-def refill(batches, fdx, fdy, batch_size, sort_and_shuffle=True):
-  line_pairs = []
-  linex, liney = fdx.readline(), fdy.readline()
+def window_batches(pairs, batch_size, sort_and_shuffle=True):
+  batches = []
+
+  while True:
+    if len(batches) == 0:
+      refill(batches, pairs, batch_size, sort_and_shuffle=sort_and_shuffle)
+    if len(batches) == 0:
+      break
 
-  while linex and liney:
-    x_tokens, y_tokens = tokenize(linex), tokenize(liney)
+    yield batches.pop(0)
+
+def bucket_batches(pairs, batch_size, buckets, max_tokens, num_layers=1, shuffle=True):
+  """Cut windows of batch_size * 16 pairs into batches of similar lengths. Each window is sorted by
+  (source, target) length bucket, then by source and target length, and a batch never spans two
+  buckets. Both sides are bucketed on their token count. With max_tokens, a batch grows until its
+  padded size (sentences times the longest side, SOS/EOS and the source alignment of padded()
+  included) would exceed the budget; otherwise it holds batch_size sentences. Without buckets the
+  window is only sorted by length, as refill does."""
+  boundaries = sorted(buckets or [])
+
+  def bucket(pair):
+    return (bisect.bisect_left(boundaries, len(pair[0])), bisect.bisect_left(boundaries, len(pair[1])))
+
+  def sort_key(pair):
+    return bucket(pair) + (len(pair[0]), len(pair[1]))
+
+  def pack(window):
+    window.sort(key=sort_key)
+    batches, batch = [], []
+    source_len = target_len = 0
+    for pair in window:
+      pair_source, pair_target = aligned_length(len(pair[0]), num_layers), len(pair[1]) + 2
+      if batch:
+        if max_tokens:
+          longest = max(source_len, pair_source, target_len, pair_target)
+          full = (len(batch) + 1) * longest > max_tokens
+        else:
+          full = len(batch) == batch_size
+        if full or bucket(pair) != bucket(batch[-1]):
+          batches.append(tuple(zip(*batch)))
+          batch, source_len, target_len = [], 0, 0
+      batch.append(pair)
+      source_len, target_len = max(source_len, pair_source), max(target_len, pair_target)
+    if batch:
+      batches.append(tuple(zip(*batch)))
+    # Shuffle among the window's batches, as refill does
+    if shuffle:
+      random.shuffle(batches)
+    return batches
+
+  window = []
+  for pair in pairs:
+    x_tokens, y_tokens = pair[:2]
+    if len(x_tokens) >= FLAGS.max_seq_len or len(y_tokens) >= FLAGS.max_seq_len:
+      continue
+    window.append(pair)
+    if len(window) == batch_size * 16:
+      for batch in pack(window):
+        yield batch
+      window = []
+  for batch in pack(window):
+    yield batch
+
+def refill(batches, pairs, batch_size, sort_and_shuffle=True):
+  line_pairs = []
 
+  for pair in pairs:
+    x_tokens, y_tokens = pair[:2]
     if len(x_tokens) < FLAGS.max_seq_len and len(y_tokens) < FLAGS.max_seq_len:
-      line_pairs.append((x_tokens, y_tokens))
+      line_pairs.append(pair)
     if len(line_pairs) == batch_size * 16:
       break
-    linex, liney = fdx.readline(), fdy.readline()
 
   if sort_and_shuffle:
     line_pairs = sorted(line_pairs, key=lambda e: len(e[0]))
 
   for batch_start in xrange(0, len(line_pairs), batch_size):
-    x_batch, y_batch = zip(*line_pairs[batch_start:batch_start+batch_size])
-#    if len(x_batch) < batch_size:
+    batch = tuple(zip(*line_pairs[batch_start:batch_start+batch_size]))
+#    if len(batch[0]) < batch_size:
 #      break
-    batches.append((x_batch, y_batch))
+    batches.append(batch)
 
   if sort_and_shuffle:
     random.shuffle(batches)
   return
 
+class Prefetcher(object):
+  """Iterate over batch_iter from a background thread, keeping up to depth batches ready in a
+  bounded queue. wait_time accumulates the time the consumer spent blocked on input; with depth 0
+  the batches are built synchronously and that time is measured all the same.
+  """
+
+  _END = object()
+
+  def __init__(self, batch_iter, depth):
+    self.batch_iter = batch_iter
+    self.depth = depth
+    self.wait_time = 0.
+    if depth > 0:
+      self.queue = queue.Queue(maxsize=depth)
+      self.thread = threading.Thread(target=self._fill)
+      self.thread.daemon = True
+      self.thread.start()
+
+  def _fill(self):
+    try:
+      for batch in self.batch_iter:
+        self.queue.put((batch, None))
+      self.queue.put((self._END, None))
+    except Exception:
+      self.queue.put((self._END, sys.exc_info()))
+
+  def _next(self):
+    if self.depth == 0:
+      return next(self.batch_iter, self._END), None
+    return self.queue.get()
+
+  def __iter__(self):
+    while True:
+      tic = time.time()
+      batch, exc_info = self._next()
+      self.wait_time += time.time() - tic
+      if exc_info is not None:
+        six.reraise(*exc_info)
+      if batch is self._END:
+        return
+      yield batch
+
 def add_sos_eos(tokens):
   return map(lambda token_list: [nlc_data.SOS_ID] + token_list + [nlc_data.EOS_ID], tokens)
 
+def aligned_length(length, depth):
+  # Sources are padded to a multiple of 2^(depth-1), which the pyramidal encoder halves per layer
+  align = pow(2, depth - 1)
+  return length + (align - length) % align
+
 def padded(tokens, depth):
   maxlen = max(map(lambda x: len(x), tokens))
-  align = pow(2, depth - 1)
-  padlen = maxlen + (align - maxlen) % align
+  padlen = aligned_length(maxlen, depth)
   return map(lambda token_list: token_list + [nlc_data.PAD_ID] * (padlen - len(token_list)), tokens)
 
 
@@ -99,3 +241,7 @@ def get_tokenizer(flags):
     raise
   return tokenizer
 
+
+def get_buckets(flags):
+  return [int(b) for b in flags.buckets.split(",") if b.strip()]
+
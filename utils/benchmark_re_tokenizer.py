@@ -0,0 +1,81 @@
+# encoding: utf-8
+"""
+Compares re_tokenizer.ReTokenizer with the per-token re-matching tokenizer the noise generation
+scripts carried before, on lines from stdin: checks that the tokens are the same and prints the
+time each takes.
+
+    head -n 100000 train.tgt.txt | python benchmark_re_tokenizer.py
+"""
+import argparse
+import sys
+import time
+
+import regex
+
+from re_tokenizer import ReTokenizer
+
+
+class LegacyReTokenizer(object):
+    ANY_WORD = ur'[\p{L}\p{M}]+'
+    ANY_WORD_RE = regex.compile(ur'(?V1p)' + ANY_WORD + '$')
+    NUMBER = ur'[\p{N}]+'
+    NUMBER_RE = regex.compile(ur'(?V1p)' + NUMBER + '$')
+    SPACE = ur'[\p{Z}]+'
+    REST = ur'[^\p{Z}\p{L}\p{M}\p{N}]'
+    TOKENIZER_RE = regex.compile(ur'(?V1p)' + u'|'.join((ANY_WORD, SPACE, NUMBER, REST)))
+    SPACE_RE = regex.compile(ur'(?V1p)^' + SPACE + '$')
+    JOINER = u'￭'
+
+    @classmethod
+    def tokenize(cls, sentence):
+        tokens = []
+        token_types = []
+        token_is_space = True
+        for w_it in cls.TOKENIZER_RE.finditer(sentence):
+            w = sentence[w_it.start():w_it.end()]
+            cur_token_is_space = True if cls.SPACE_RE.match(w) else False
+            if not token_is_space and not cur_token_is_space:
+                tokens.append(cls.JOINER)
+                token_types.append('J')
+            token_is_space = cur_token_is_space
+            if not cur_token_is_space:
+                tokens.append(w)
+                if cls.ANY_WORD_RE.match(w):
+                    token_types.append('W')
+                elif cls.NUMBER_RE.match(w):
+                    token_types.append('N')
+                else:
+                    token_types.append('R')
+        return tokens, token_types
+
+
+def timed(f, *args):
+    tic = time.time()
+    result = f(*args)
+    return result, time.time() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the single-pass tokenizer against the legacy one.')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    args = parser.parse_args()
+
+    lines = [l.decode('utf-8').strip(u'\n') for l in sys.stdin]
+    tokenizer = ReTokenizer()
+
+    legacy, legacy_time = timed(lambda: [LegacyReTokenizer.tokenize(l) for l in lines])
+    single, single_time = timed(lambda: [tokenizer.tokenize(l) for l in lines])
+    batched, batch_time = timed(lambda: [t for i in xrange(0, len(lines), args.batch_size)
+                                         for t in tokenizer.tokenize_batch(lines[i:i + args.batch_size])])
+
+    assert single == legacy, 'tokenize differs from the legacy tokenizer'
+    assert batched == legacy, 'tokenize_batch differs from the legacy tokenizer'
+    num_tokens = sum(len(tokens) for tokens, _ in legacy)
+    print '%d lines, %d tokens' % (len(lines), num_tokens)
+    for name, seconds in (('legacy', legacy_time), ('tokenize', single_time), ('tokenize_batch', batch_time)):
+        print '%-15s %8.3fs %10.0f lines/s %5.2fx' % (name, seconds, len(lines) / max(seconds, 1e-9),
+                                                     legacy_time / max(seconds, 1e-9))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,14 @@
 # encoding: utf-8
 from booking_mtlib.parallelize import multiprocess
+import argparse
 import regex
+import re_tokenizer
 import sys
 from collections import defaultdict
 
-class ReTokenizer(object):
-    ANY_WORD = ur'[\p{L}\p{M}■]+'
-    NAMED_ENTITY = ur'＃[\p{L}\p{M}\p{N}：]+'
-    NUMBER = ur'[\p{N}]+'
-    SPACE = ur'[\p{Z}]+'
-    REST = ur'[^\p{Z}\p{L}\p{M}\p{N}：■＃]'
-    TOKENIZER_RE = regex.compile(ur'(?V1p)' + u'|'.join((ANY_WORD, NAMED_ENTITY, SPACE, NUMBER, REST)))
-    SPACE_RE = regex.compile(ur'(?V1p)^[\p{Z}]+$')
-    JOINER = u'￭'
-    JOINER_RE = regex.compile(ur'(?V1p) ￭ ')
-    
-    @classmethod
-    def tokenize(cls, sentence):
-        tokens = []
-        token_is_space = True
-        for w_it in cls.TOKENIZER_RE.finditer(sentence):
-            w = sentence[w_it.start():w_it.end()]
-            cur_token_is_space = True if cls.SPACE_RE.match(w) else False
-            if not token_is_space and not cur_token_is_space:
-                tokens.append(cls.JOINER)
-            token_is_space = cur_token_is_space
-            if not cur_token_is_space:
-                tokens.append(w)
-        return tokens
-
-    @classmethod
-    def detokenize(cls, tokens):
-        words = u' '.join(tokens)
-        return cls.JOINER_RE.sub(u'', words)
+ReTokenizer = re_tokenizer.ReTokenizer(word_chars=u'■', named_entity=True, joiner_re=ur' ￭ ', types=False)
+
+LETTERS = u'abcdefghijklmnopqrstuvwxyz'
 
 def edits1(word):
     "All edits that are one edit away from `word`."
@@ -54,19 +30,109 @@ def print_all_edits(word):
         if e in all_words:
             word_graph[w].add(e)
 
+def edit_distance(source, target):
+    """Damerau-Levenshtein distance (Lowrance-Wagner, so transposed characters may have edits
+    between them) from source to target, with the edits edits1 makes: any character may be
+    deleted, but only LETTERS may be inserted or substituted in."""
+    n, m = len(source), len(target)
+    never = float('inf')
+    # Non-letters in target[:j]; those can only come from source
+    bad = [0] * (m + 1)
+    for j, c in enumerate(target):
+        bad[j + 1] = bad[j] + (c not in LETTERS)
+
+    d = [[never] * (m + 2) for _ in range(n + 2)]
+    for i in range(n + 1):
+        d[i + 1][1] = i
+    for j in range(1, m + 1):
+        d[1][j + 1] = j if bad[j] == 0 else never
+    last_row = {}
+    for i in range(1, n + 1):
+        last_col = 0
+        for j in range(1, m + 1):
+            i1 = last_row.get(target[j - 1], 0)
+            j1 = last_col
+            if source[i - 1] == target[j - 1]:
+                cost = 0
+                last_col = j
+            else:
+                cost = 1 if target[j - 1] in LETTERS else never
+            insert = 1 if target[j - 1] in LETTERS else never
+            # Transposition, deleting what lies between in source and inserting what lies between in target
+            between = (j - j1 - 1) if bad[j - 1] == bad[j1] else never
+            d[i + 1][j + 1] = min(d[i][j] + cost,
+                                  d[i + 1][j] + insert,
+                                  d[i][j + 1] + 1,
+                                  d[i1][j1] + (i - i1 - 1) + 1 + between)
+        last_row[source[i - 1]] = i
+    return d[n + 1][m + 1]
+
+def moved_by_two(source, target):
+    """Whether target is source with one character moved two places, by two transpositions. With
+    only letters insertable, edit_distance cannot always express that as a transposition."""
+    if len(source) != len(target):
+        return False
+    diffs = [i for i, (a, b) in enumerate(zip(source, target)) if a != b]
+    if not diffs or diffs[-1] - diffs[0] != 2:
+        return False
+    i, j = diffs[0], diffs[-1] + 1
+    return target[i:j] in (source[i+1:j] + source[i], source[j-1] + source[i:j-1])
+
+def deletes(word, depth):
+    "The word and every string made by deleting up to `depth` of its characters."
+    result = frontier = set([word])
+    for _ in range(depth):
+        frontier = set(w[:i] + w[i+1:] for w in frontier for i in range(len(w)))
+        result = result | frontier
+    return result
+
+class SymSpellIndex(object):
+    """Symmetric delete index: two words within max_distance edits of each other share a string
+    made by deleting at most max_distance characters from each, so only words sharing such a
+    deletion need an edit_distance check."""
+
+    def __init__(self, words, max_distance=2):
+        self.max_distance = max_distance
+        self.variants = defaultdict(list)
+        for word in words:
+            for variant in deletes(word, max_distance):
+                self.variants[variant].append(word)
+
+    def neighbours(self, word):
+        # Same set as edits1/edits2 intersected with the words. That includes the word itself,
+        # since edits2 can insert a letter and delete it again.
+        candidates = set()
+        for variant in deletes(word, self.max_distance):
+            candidates.update(self.variants.get(variant, ()))
+        return set(c for c in candidates
+                   if c == word or edit_distance(word, c) <= self.max_distance or moved_by_two(word, c))
+
 def main():
+    parser = argparse.ArgumentParser(description='Prints every word from stdin with the words within two edits of it.')
+    parser.add_argument('--brute_force', action='store_true',
+                        help='Generate all edits2 of every word instead of using the symmetric delete index.')
+    parser.add_argument('--processes', type=int, default=24)
+    args = parser.parse_args()
+
     words = set()
     for l in sys.stdin:
         words.add(l.strip('\n').decode('utf-8'))
 
+    if args.brute_force:
+        def all_edits(word):
+            all_edits = set()
+            for e in tuple(edits2(word)) + tuple(edits1(word)):
+                if e in words:
+                    all_edits.add(e)
+            return all_edits
+    else:
+        index = SymSpellIndex(words)
+        all_edits = index.neighbours
+
     def print_all_edits(word):
-        all_edits = set()
-        for e in tuple(edits2(word)) + tuple(edits1(word)):
-            if e in words:
-                all_edits.add(e)
-        return u"\t".join((word, ",".join(all_edits))).encode('utf-8')
-                
-    for l in multiprocess(print_all_edits, words, 24):
+        return u"\t".join((word, ",".join(all_edits(word)))).encode('utf-8')
+
+    for l in multiprocess(print_all_edits, words, args.processes):
         print l
 
 if __name__ == "__main__":
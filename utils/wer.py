@@ -5,6 +5,9 @@ from __future__ import unicode_literals, division, print_function
 
 import collections
 import argparse
+import csv
+import json
+import multiprocessing
 
 class TranscriptionErrorType(object):
     """Enumeration of 4 possible errors: correct (no error), substitution, insertion and deletion."""
@@ -20,6 +23,9 @@ class FileFormat(object):
 WERResult = collections.namedtuple('WERResult', ['score', 'errors'])
 UtteranceResult = collections.namedtuple('UtteranceResult', ['reference', 'hypothesis', 'wer'])
 FileResults = collections.namedtuple('FileResults', ['score', 'utterances'])
+HypothesisScores = collections.namedtuple('HypothesisScores', ['filename', 'score', 'utterances'])
+RankedHypothesis = collections.namedtuple('RankedHypothesis', ['rank', 'filename', 'score', 'utterances', 'wins'])
+UtteranceWinners = collections.namedtuple('UtteranceWinners', ['muuid', 'score', 'winners', 'scores'])
 
 
 NUMBER_CONVERSIONS = {
@@ -194,10 +200,37 @@ def format_errors(errors):
     return " ".join(ref), " ".join(hyp)
 
 
+# Back-pointers of the WER table: which step reached a cell
+_CORRECT, _SUBSTITUTION, _INSERTION, _DELETION = range(4)
+
+_EQUIV_INDEXES = {}
+
+
+def _equiv_index(equiv_classes):
+    """Return a dict of word => set of indices of the equivalence classes containing it.
+
+    Indices are cached by the identity of `equiv_classes`, which are usually one of the module constants.
+
+    """
+    cached = _EQUIV_INDEXES.get(id(equiv_classes))
+    if cached is not None and cached[0] is equiv_classes:
+        return cached[1]
+    index = collections.defaultdict(set)
+    for k, equiv in enumerate(equiv_classes):
+        for word in equiv:
+            index[word].add(k)
+    index = dict(index)
+    if len(_EQUIV_INDEXES) >= 16:
+        _EQUIV_INDEXES.clear()
+    _EQUIV_INDEXES[id(equiv_classes)] = (equiv_classes, index)
+    return index
+
+
 def wer(ref_sentence, hyp_sentence, conversions=None, equiv_classes=tuple(), strip_end_punct=False):
     """Calculate Word Error Rate with Levenshtein Distance.
 
-    Complexity is O(nm) in time and space, and uses sets of errors so we can analyze the results later.
+    Complexity is O(nm) in time and space: the table holds integer costs and back-pointers, and the errors are collected by a
+    single backtrace from the last cell so we can analyze the results later.
 
     Arguments:
         ref_sentence: unicode sentence, the correct transcriptions
@@ -226,46 +259,106 @@ def wer(ref_sentence, hyp_sentence, conversions=None, equiv_classes=tuple(), str
             return WERResult(0, [])
         else:
             return WERResult(len(hyp), tuple(TranscriptionError(T.insertion, 0, None, word) for word in hyp))
-    # Each cell holds None (uncomputed), or a tuple of known errors till this position (starts from 0) - not including the position
-    # i is always the position/index to the reference word, while j is an index/position of the hypothesis word
-    err = [[None] * (len(hyp) + 1) for _ in range(len(ref) + 1)]
-    err[0][0] = tuple()
-    if len(ref):
-        err[1][0] = tuple()
-    if len(hyp):
-        err[0][1] = tuple()
-    for i in range(1, len(err)):
-        err[i][0] = err[i-1][0] + (TranscriptionError(T.deletion, i-1, ref[i-1], None),)
-    for j in range(1, len(err[0])):
-        err[0][j] = err[0][j-1] + (TranscriptionError(T.insertion, j-1, None, hyp[j-1]),)
-
-    for i in range(1, len(err)):
-        for j in range(1, len(err[0])):
-            if ref[i-1] == hyp[j-1] or any({ref[i-1], hyp[j-1]} <= equiv for equiv in equiv_classes):
-                err[i][j] = err[i-1][j-1] + (TranscriptionError(T.correct, i-1, ref[i-1], hyp[j-1]),)
+    # i is always the position/index to the reference word, while j is an index/position of the hypothesis word.
+    # cost[i][j] is the number of errors aligning ref[:i] with hyp[:j], and back[i][j] the step that reached it
+    n, m = len(ref), len(hyp)
+    index = _equiv_index(equiv_classes)
+    no_classes = frozenset()
+    hyp_classes = [index.get(word, no_classes) for word in hyp]
+    cost = [list(range(m + 1))]
+    back = [bytearray([_INSERTION]) * (m + 1)]
+    for i in range(1, n + 1):
+        ref_word = ref[i-1]
+        ref_classes = index.get(ref_word, no_classes)
+        above = cost[i-1]
+        row = [i] * (m + 1)
+        pointers = bytearray([_DELETION]) * (m + 1)
+        for j in range(1, m + 1):
+            if ref_word == hyp[j-1] or (ref_classes and not ref_classes.isdisjoint(hyp_classes[j-1])):
+                row[j] = above[j-1]
+                pointers[j] = _CORRECT
             else:
-                deletion = (err[i-1][j], TranscriptionError(T.deletion, i-1, ref[i-1], None))
-                insertion = (err[i][j-1], TranscriptionError(T.insertion, 0, None, hyp[j-1]))
-                substitution = (err[i-1][j-1], TranscriptionError(T.substitution, i-1, ref[i-1], hyp[j-1]))
-                best = sorted([substitution, insertion, deletion], key=lambda errs: sum(x.type_ != T.correct for x in errs[0]))[0]
-                err[i][j] = best[0] + (best[1],)
+                # All three steps add one error; ties prefer substitution, then insertion, then deletion
+                best, step = above[j-1], _SUBSTITUTION
+                if row[j-1] < best:
+                    best, step = row[j-1], _INSERTION
+                if above[j] < best:
+                    best, step = above[j], _DELETION
+                row[j] = best + 1
+                pointers[j] = step
+        cost.append(row)
+        back.append(pointers)
+
+    errors = []
+    i, j = n, m
+    while i or j:
+        step = back[i][j]
+        if step == _CORRECT:
+            errors.append(TranscriptionError(T.correct, i-1, ref[i-1], hyp[j-1]))
+            i, j = i - 1, j - 1
+        elif step == _SUBSTITUTION:
+            errors.append(TranscriptionError(T.substitution, i-1, ref[i-1], hyp[j-1]))
+            i, j = i - 1, j - 1
+        elif step == _INSERTION:
+            # Insertions on the first row are numbered by hypothesis position, the others are all at position 0
+            errors.append(TranscriptionError(T.insertion, j-1 if i == 0 else 0, None, hyp[j-1]))
+            j -= 1
+        else:
+            errors.append(TranscriptionError(T.deletion, i-1, ref[i-1], None))
+            i -= 1
+    errors.reverse()
+    return WERResult(cost[n][m] / n, tuple(errors))
+
+
+_WER_ARGS = None
 
-    score = sum(x.type_ != T.correct for x in err[len(ref)][len(hyp)]) / len(ref)
-    return WERResult(score, err[len(ref)][len(hyp)])
 
+def _init_wer_worker(conversions, equiv_classes, strip_end_punct):
+    """Store the arguments shared by all pairs in a pool worker"""
+    global _WER_ARGS # pylint: disable=global-statement
+    _WER_ARGS = (conversions, equiv_classes, strip_end_punct)
 
-def _wer_many(ref_sentences, asr_sentences, conversions=None, equiv_classes=tuple(), nbest=False, strip_end_punct=False):
+
+def _wer_pair(pair):
+    """Run wer() on a (reference, hypotheses) pair in a pool worker; hypotheses is a list in n-best mode, otherwise a sentence"""
+    ref, asr = pair
+    if isinstance(asr, list):
+        return [wer(ref, hyp, *_WER_ARGS) for hyp in asr]
+    return wer(ref, asr, *_WER_ARGS)
+
+
+def wer_batch(ref_sentences, asr_sentences, conversions=None, equiv_classes=tuple(), strip_end_punct=False, processes=1,
+              chunksize=256):
+    """Run wer() for each pair of sentences and return the list of WERResults, in order.
+
+    With `processes` above 1 the pairs are scored in a process pool. An element of `asr_sentences` can be a list of hypotheses,
+    and then its element in the result is the list of their WERResults.
+
+    """
+    pairs = zip(ref_sentences, asr_sentences)
+    if processes <= 1:
+        _init_wer_worker(conversions, equiv_classes, strip_end_punct)
+        return [_wer_pair(pair) for pair in pairs]
+    pool = multiprocessing.Pool(processes, _init_wer_worker, (conversions, equiv_classes, strip_end_punct))
+    try:
+        return pool.map(_wer_pair, pairs, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _wer_many(ref_sentences, asr_sentences, conversions=None, equiv_classes=tuple(), nbest=False, strip_end_punct=False,
+              processes=1):
     """Run WER for each pair of sentences, and in addition, calculates the total WER.
 
-    Returns the (total WER, list of UtteranceResult). For parameters, see wer() function.
+    Returns the (total WER, list of UtteranceResult). For parameters, see wer() and wer_batch() functions.
 
     """
+    single_results = wer_batch(ref_sentences, [list(asrs) for asrs in asr_sentences] if nbest else asr_sentences,
+                               conversions, equiv_classes, strip_end_punct, processes)
     if nbest:
         # running wer() for each ASR hypothesis, then taking the minimal WER are discard all others
-        single_results = [sorted(wer(ref, asr, conversions, equiv_classes, strip_end_punct) for asr in asrs)[0]
-                          for ref, asrs in zip(ref_sentences, asr_sentences)]
-    else:
-        single_results = [wer(ref, asr, conversions, equiv_classes, strip_end_punct) for ref, asr in zip(ref_sentences, asr_sentences)]
+        single_results = [sorted(results)[0] for results in single_results]
     # Undoing the division to get the total number of errors
     scores = [result.score for result in single_results]
     total_wer = [(score, len(ref.strip().split())) for score, ref in zip(scores, ref_sentences)]
@@ -273,45 +366,148 @@ def _wer_many(ref_sentences, asr_sentences, conversions=None, equiv_classes=tupl
     return total_wer, single_results
 
 
-def read_transcriptions(fil, format_, encoding='utf-8', nbest=False):
-    """Read transcriptions from a file with the specified format and encoding and return MUUID => transcription dictionary.
-
-    Possible formats are from FileFormat. if `fil` is a string, assume its a filename and try to open it, otherwise assume file
-    object.
+def iter_transcriptions(fil, format_, encoding='utf-8'):
+    """Yield (MUUID, transcription) pairs from a file with the specified format and encoding, in file order.
 
-    if `nbest` is True, assume there can be several transcriptions per MUUID, and return a dictionary of
-    MUUID => list of transcriptions, in the order they appear in the file. If `nbest` is False, return MUUID => first transcription
-    appearing in the file (the file can contain multiple transcriptions).
+    The file is read line by line, so only the current line is held in memory. Lines are decoded one at a time (the encoding
+    must be ASCII-compatible, so a newline byte always ends a line) and split further on unicode line breaks, like splitlines()
+    of the whole decoded file. Blank lines are skipped. For `fil` and `format_`, see read_transcriptions().
 
     """
 
     def read_paren_transcriptions(lines):
-        """Read the parentheses-formatted transcriptions in the format TRANSCRIPTION ... (MUUID1). Return list of (MUUID, text)."""
+        """Read the parentheses-formatted transcriptions in the format TRANSCRIPTION ... (MUUID1). Yield (MUUID, text)."""
         # if a file failed transcription, then only its MUUID in parenthesis is on the line - check for it
-        data = [line.rsplit(' ', 1) if ' ' in line else ('', line) for line in lines]
-        return [(muuid[1:-1], text) for text, muuid in data]
+        data = (line.rsplit(' ', 1) if ' ' in line else ('', line) for line in lines)
+        return ((muuid[1:-1], text) for text, muuid in data)
 
     def read_tsv_transcriptions(lines):
-        """Read tab-separated transcriptions and return a list of (MUUID, transcription)"""
-        return [line.split('\t') for line in lines]
+        """Read tab-separated transcriptions and yield (MUUID, transcription)"""
+        return (line.split('\t') for line in lines)
 
     def read_spaced_transcriptions(lines):
-        """Read space-separated transcriptions (MUUID TEXT) and return list of (MUUID, transcription)"""
-        return [line.split(" ", 1) for line in lines]
+        """Read space-separated transcriptions (MUUID TEXT) and yield (MUUID, transcription)"""
+        return (line.split(" ", 1) for line in lines)
 
     extractors = {FileFormat.parentheses: read_paren_transcriptions,
                   FileFormat.tsv: read_tsv_transcriptions,
                   FileFormat.space: read_spaced_transcriptions}
+    extractor = extractors[format_]
     if isinstance(fil, basestring):
         fil = open(fil, 'rU')
-    data = extractors[format_](line for line in fil.read().decode(encoding).splitlines() if line.strip())
+    lines = (line for raw in fil for line in raw.decode(encoding).splitlines() if line.strip())
+    for muuid, text in extractor(lines):
+        yield muuid, text
+
+
+def read_transcriptions(fil, format_, encoding='utf-8', nbest=False):
+    """Read transcriptions from a file with the specified format and encoding and return MUUID => transcription dictionary.
+
+    Possible formats are from FileFormat. if `fil` is a string, assume its a filename and try to open it, otherwise assume file
+    object.
+
+    if `nbest` is True, assume there can be several transcriptions per MUUID, and return a dictionary of
+    MUUID => list of transcriptions, in the order they appear in the file. If `nbest` is False, return MUUID => first transcription
+    appearing in the file (the file can contain multiple transcriptions).
+
+    """
+    data = iter_transcriptions(fil, format_, encoding)
     if nbest:
         out = collections.defaultdict(list)
         for muuid, text in data:
             out[muuid].append(text)
         return dict(out)
     else:
-        return dict(reversed(data)) # Reverse the data so the first transcription will overwrite the others, and we get only firsts
+        out = {}
+        for muuid, text in data:
+            if muuid not in out: # only the first transcription of a MUUID is kept
+                out[muuid] = text
+        return out
+
+
+def _group_sorted(pairs, nbest=False):
+    """Group (MUUID, transcription) pairs sorted by MUUID, yielding (MUUID, first transcription) or (MUUID, list of all) if `nbest`"""
+    previous = None
+    texts = []
+    for muuid, text in pairs:
+        if previous is not None and muuid < previous:
+            raise ValueError('transcriptions are not sorted by MUUID: {!r} follows {!r}'.format(muuid, previous))
+        if muuid != previous:
+            if texts:
+                yield previous, texts if nbest else texts[0]
+            previous = muuid
+            texts = []
+        texts.append(text)
+    if texts:
+        yield previous, texts if nbest else texts[0]
+
+
+def merge_transcriptions(pairs1, pairs2, nbest=False):
+    """Align two streams of (MUUID, transcription) pairs sorted by MUUID (as `LC_ALL=C sort` does), yielding (muuid, trans1, trans2).
+
+    This is align_transcriptions() without partial matching, by merging the streams, so memory does not grow with their length.
+    The first transcription of a MUUID is used from `pairs1`, and from `pairs2` too unless `nbest` is True, where trans2 is the list
+    of all its transcriptions. A ValueError is raised when a stream is out of order.
+
+    """
+    groups1 = _group_sorted(pairs1)
+    groups2 = _group_sorted(pairs2, nbest)
+    muuid1, tr1 = next(groups1, (None, None))
+    muuid2, tr2 = next(groups2, (None, None))
+    while muuid1 is not None and muuid2 is not None:
+        if muuid1 == muuid2:
+            yield muuid1, tr1, tr2
+            muuid1, tr1 = next(groups1, (None, None))
+            muuid2, tr2 = next(groups2, (None, None))
+        elif muuid1 < muuid2:
+            muuid1, tr1 = next(groups1, (None, None))
+        else:
+            muuid2, tr2 = next(groups2, (None, None))
+
+
+class SubstringIndex(object):
+    """Find the keys of a collection of strings which contain a query string, or are contained in it.
+
+    Keys are indexed by their q-grams: the keys containing a query are among the keys having its rarest q-gram, and the keys
+    contained in a query are its substrings with the lengths of the keys. Queries shorter than q are matched with a linear scan.
+
+    """
+
+    def __init__(self, keys, q=4):
+        self.q = q
+        self.keys = set(keys)
+        self.lengths = sorted(set(len(key) for key in self.keys))
+        self.postings = collections.defaultdict(list)
+        for key in self.keys:
+            for gram in set(key[k:k + q] for k in range(len(key) - q + 1)):
+                self.postings[gram].append(key)
+
+    def superstrings(self, query):
+        """Return the keys containing `query`"""
+        q = self.q
+        if len(query) < q:
+            return [key for key in self.keys if query in key]
+        candidates = None
+        for k in range(len(query) - q + 1):
+            posting = self.postings.get(query[k:k + q])
+            if posting is None:
+                return []
+            if candidates is None or len(posting) < len(candidates):
+                candidates = posting
+        return [key for key in candidates if query in key]
+
+    def substrings(self, query):
+        """Return the keys contained in `query`"""
+        found = set()
+        for length in self.lengths:
+            if length > len(query):
+                break
+            found.update(sub for sub in (query[k:k + length] for k in range(len(query) - length + 1)) if sub in self.keys)
+        return list(found)
+
+    def matches(self, query):
+        """Return the keys which contain `query` or are contained in it"""
+        return list(set(self.superstrings(query)).union(self.substrings(query)))
 
 
 def align_transcriptions(map1, map2, partial=False):
@@ -321,19 +517,23 @@ def align_transcriptions(map1, map2, partial=False):
     at only one mapping are removed.
 
     If `partial` is True, it enables the one MUUID to be the the substring of another to construct a match, so it enables short
-    MUUIDs to be mapped to longer one which has more data (session id, user etc.).
+    MUUIDs to be mapped to longer one which has more data (session id, user etc.). Partial matches are looked up in a
+    SubstringIndex of the MUUIDs of `map2`, built on the first MUUID without an exact match.
 
     """
     muuids = []
     trans1 = []
     trans2 = []
+    index = None
     for muuid1, tr1 in map1.items():
         if muuid1 in map2:
             muuids.append(muuid1)
             trans1.append(tr1)
             trans2.append(map2[muuid1])
         elif partial:
-            matches = [muuid2 for muuid2 in map2 if muuid1 in muuid2 or muuid2 in muuid1]
+            if index is None:
+                index = SubstringIndex(map2)
+            matches = index.matches(muuid1)
             if matches:
                 assert len(matches) == 1
                 muuid2 = matches[0]
@@ -344,25 +544,142 @@ def align_transcriptions(map1, map2, partial=False):
 
 
 def get_wer_for_file(ref_file, hyp_file, ref_format=FileFormat.tsv, hyp_format=FileFormat.tsv,
-                     equiv_classes=EQUIV_ALL, nbest=False, strip_end_punct=False):
+                     equiv_classes=EQUIV_ALL, nbest=False, strip_end_punct=False, processes=1):
     """Return WER and detailed changes for hypothesis transcriptions.
 
     ref_file: text file with transcriptions at `ref_format` (either filename or file object)
     hyp_file: text file with transcriptions at `hyp_format` (either filename or file object)
+    processes: number of processes scoring the utterances
 
     Return (WER (float), dict of MUUID => (ref, hyp, list of TranscriptionErrors)).
 
     """
     ref_map = read_transcriptions(ref_file, ref_format)
     asr_map = read_transcriptions(hyp_file, hyp_format, nbest=nbest)
+    return get_wer_for_maps(ref_map, asr_map, equiv_classes, nbest, strip_end_punct, processes)
+
+
+def get_wer_for_maps(ref_map, asr_map, equiv_classes=EQUIV_ALL, nbest=False, strip_end_punct=False, processes=1):
+    """Return WER and detailed changes for mappings of MUUID => transcription(s) from read_transcriptions(). See get_wer_for_file()"""
     muuids, ref_sentences, asr_sentences = align_transcriptions(ref_map, asr_map, partial=True)
     total_wer, wer_results = _wer_many(ref_sentences, asr_sentences, conversions=NUMBER_CONVERSIONS, equiv_classes=equiv_classes,
-                                       nbest=nbest, strip_end_punct=strip_end_punct)
+                                       nbest=nbest, strip_end_punct=strip_end_punct, processes=processes)
     results = {muuid: UtteranceResult(ref, asr, wer_result)
                for muuid, ref, asr, wer_result in zip(muuids, ref_sentences, asr_sentences, wer_results)}
     return FileResults(total_wer, results)
 
 
+def get_wer_for_sorted_files(ref_file, hyp_file, ref_format=FileFormat.tsv, hyp_format=FileFormat.tsv,
+                             equiv_classes=EQUIV_ALL, nbest=False, strip_end_punct=False):
+    """Return the WER of hypothesis transcriptions, for files sorted by MUUID.
+
+    The files are aligned by merge_transcriptions() and each utterance is scored as it is read, so memory stays constant however
+    large the files are. Only exact MUUID matches are used, and the returned FileResults has no utterances.
+
+    """
+    errors = 0
+    words = 0
+    merged = merge_transcriptions(iter_transcriptions(ref_file, ref_format), iter_transcriptions(hyp_file, hyp_format), nbest)
+    for muuid, ref, asr in merged: # pylint: disable=unused-variable
+        if nbest:
+            score = min(wer(ref, hyp, NUMBER_CONVERSIONS, equiv_classes, strip_end_punct).score for hyp in asr)
+        else:
+            score = wer(ref, asr, NUMBER_CONVERSIONS, equiv_classes, strip_end_punct).score
+        length = len(ref.strip().split())
+        errors += score * length
+        words += length
+    return FileResults(errors / words, {})
+
+
+_COMPARE_ARGS = None
+
+
+def _init_compare_worker(ref_map, equiv_classes, nbest, strip_end_punct):
+    """Store the reference and scoring options in a pool worker, so they are sent once per worker rather than once per file"""
+    global _COMPARE_ARGS # pylint: disable=global-statement
+    _COMPARE_ARGS = (ref_map, equiv_classes, nbest, strip_end_punct)
+
+
+def _score_hypothesis_file(file_and_format):
+    """Score one hypothesis file against the worker's reference, returning HypothesisScores with MUUID => WER of the utterances"""
+    filename, format_ = file_and_format
+    ref_map, equiv_classes, nbest, strip_end_punct = _COMPARE_ARGS
+    asr_map = read_transcriptions(filename, format_, nbest=nbest)
+    file_results = get_wer_for_maps(ref_map, asr_map, equiv_classes, nbest, strip_end_punct)
+    return HypothesisScores(filename, file_results.score,
+                            {muuid: utterance.wer.score for muuid, utterance in file_results.utterances.iteritems()})
+
+
+def compare_hypotheses(ref_file, hyp_files, ref_format=FileFormat.tsv, hyp_formats=None, equiv_classes=EQUIV_ALL, nbest=False,
+                       strip_end_punct=False, processes=None):
+    """Score any number of hypothesis files against one reference, and rank them.
+
+    The reference is read once, and the hypothesis files (filenames, with formats in `hyp_formats`, default tsv) are scored in
+    `processes` worker processes (default one per CPU).
+
+    Return (list of RankedHypothesis by increasing WER, list of UtteranceWinners sorted by MUUID). An utterance's winners are the
+    files with its lowest WER, all of them on ties, and `wins` of a file counts the utterances it is a winner of.
+
+    """
+    hyp_formats = hyp_formats or [FileFormat.tsv] * len(hyp_files)
+    ref_map = read_transcriptions(ref_file, ref_format)
+    jobs = zip(hyp_files, hyp_formats)
+    if processes == 1 or len(jobs) == 1:
+        _init_compare_worker(ref_map, equiv_classes, nbest, strip_end_punct)
+        file_scores = [_score_hypothesis_file(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes, _init_compare_worker, (ref_map, equiv_classes, nbest, strip_end_punct))
+        try:
+            file_scores = pool.map(_score_hypothesis_file, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    utterances = []
+    wins = collections.Counter()
+    for muuid in sorted(set().union(*(scores.utterances for scores in file_scores))):
+        scores = collections.OrderedDict((scores.filename, scores.utterances[muuid]) for scores in file_scores
+                                         if muuid in scores.utterances)
+        best = min(scores.itervalues())
+        winners = [filename for filename, score in scores.iteritems() if score == best]
+        wins.update(winners)
+        utterances.append(UtteranceWinners(muuid, best, winners, scores))
+    ranking = [RankedHypothesis(rank, scores.filename, scores.score, len(scores.utterances), wins[scores.filename])
+               for rank, scores in enumerate(sorted(file_scores, key=lambda scores: scores.score), 1)]
+    return ranking, utterances
+
+
+def _encode_row(row):
+    """Encode the unicode values of a csv row to utf-8, for the python 2 csv module"""
+    return [value.encode('utf-8') if isinstance(value, unicode) else value for value in row]
+
+
+def write_comparison_report(filename, ranking, utterances):
+    """Write the results of compare_hypotheses() as JSON, or as CSV if `filename` ends with .csv.
+
+    The JSON report is an object with the `ranking` and the per-utterance `utterances`. A CSV report is the ranking, and the
+    utterances go to a second file with the .utterances.csv suffix: muuid, best WER, winners (separated by |) and the WER of
+    each file (empty where the file has no such utterance).
+
+    """
+    if not filename.endswith('.csv'):
+        with open(filename, 'w') as fil:
+            json.dump({'ranking': [ranked._asdict() for ranked in ranking],
+                       'utterances': [utterance._asdict() for utterance in utterances]}, fil, indent=2)
+        return
+    with open(filename, 'wb') as fil:
+        writer = csv.writer(fil)
+        writer.writerow(RankedHypothesis._fields)
+        writer.writerows(_encode_row(ranked) for ranked in ranking)
+    filenames = [ranked.filename for ranked in ranking]
+    with open(filename[:-len('.csv')] + '.utterances.csv', 'wb') as fil:
+        writer = csv.writer(fil)
+        writer.writerow(_encode_row(['muuid', 'score', 'winners'] + filenames))
+        for utterance in utterances:
+            writer.writerow(_encode_row([utterance.muuid, utterance.score, '|'.join(utterance.winners)] +
+                                        [utterance.scores.get(name, '') for name in filenames]))
+
+
 def get_errors_breakdown(file_results, aggregate_substitutions=True):
     """Return a dictionary of TranscriptionErrorType => Counter of error word(s).
 
@@ -508,16 +825,40 @@ def _output_3way_results(filename1, file_results1, filename2, file_results2, out
             raise ValueError('breakdown comparison not supported')
 
 
+def _output_comparison(ranking):
+    """Print the ranked summary of compare_hypotheses()"""
+    length = max(len(ranked.filename) for ranked in ranking)
+    fmt = '{{:>4}}  {{:>7}}  {{:>10}}  {{:>6}}  {{:{length}}}'.format(length=length)
+    print(fmt.format('rank', 'WER', 'utterances', 'wins', 'hypothesis'))
+    for ranked in ranking:
+        print(fmt.format(ranked.rank, '{:.2%}'.format(ranked.score), ranked.utterances, ranked.wins, ranked.filename))
+
+
 def main(args):
     """Calculate WER for a given file and prints output"""
     equiv = _get_equiv(args.suppress)
     ref_format = args.ref_format or _guess_format(args.reference.name)
+    if args.compare:
+        hyp_files = [args.hypothesis.name] + args.compare
+        hyp_formats = [args.hyp_format or _guess_format(filename) for filename in hyp_files]
+        ranking, utterances = compare_hypotheses(args.reference, hyp_files, ref_format, hyp_formats, equiv, args.nbest,
+                                                 args.strip_end_punct, args.processes)
+        _output_comparison(ranking)
+        if args.report:
+            write_comparison_report(args.report, ranking, utterances)
+        return
     hyp_format = args.hyp_format or _guess_format(args.hypothesis.name)
-    file_results = get_wer_for_file(args.reference, args.hypothesis, ref_format, hyp_format, equiv, args.nbest, args.strip_end_punct)
+    if args.sorted:
+        get_results = lambda hyp_file, hyp_format: get_wer_for_sorted_files(args.reference, hyp_file, ref_format, hyp_format, equiv,
+                                                                            args.nbest, args.strip_end_punct)
+    else:
+        get_results = lambda hyp_file, hyp_format: get_wer_for_file(args.reference, hyp_file, ref_format, hyp_format, equiv,
+                                                                    args.nbest, args.strip_end_punct, args.processes or 1)
+    file_results = get_results(args.hypothesis, hyp_format)
     if args.hypothesis2:
         args.reference.seek(0)
         hyp2_format = args.hyp2_format or _guess_format(args.hypothesis2.name)
-        file_results2 = get_wer_for_file(args.reference, args.hypothesis2, ref_format, hyp2_format, equiv, args.nbest, args.strip_end_punct)
+        file_results2 = get_results(args.hypothesis2, hyp2_format)
         _output_3way_results(args.hypothesis.name, file_results, args.hypothesis2.name, file_results2, args.output)
     else:
         _output_results(file_results, args.output)
@@ -542,9 +883,23 @@ def parse_args():
     parser.add_argument('--3way-format', choices=FileFormat.values, dest='hyp2_format',
                         help='Second hypothesis file format, in case it is supplied')
     parser.add_argument('--strip-end-punct', action='store_true')
+    parser.add_argument('--processes', type=int,
+                        help='number of processes scoring the utterances, or the files with --compare (default 1, one per CPU with --compare)')
+    parser.add_argument('--sorted', action='store_true',
+                        help='files are sorted by MUUID: align them by merging in constant memory (exact MUUIDs, score output only)')
+    parser.add_argument('--compare', nargs='+', metavar='HYPOTHESIS',
+                        help='more hypothesis files to rank together with the first one, scored in parallel against the reference')
+    parser.add_argument('--report', help='with --compare, write the ranking and per-utterance winners to this JSON file '
+                                         '(or CSV, if it ends with .csv)')
     args = parser.parse_args()
     if not args.output:
         args.output = ['score']
+    if args.sorted and set(args.output) != {'score'}:
+        parser.error('--sorted only supports the score output')
+    if args.compare and (args.hypothesis2 or args.sorted or set(args.output) != {'score'}):
+        parser.error('--compare only supports the score output, without --3way and --sorted')
+    if args.report and not args.compare:
+        parser.error('--report requires --compare')
     if not args.suppress:
         args.suppress = ['all']
     return args